@@ -0,0 +1,87 @@
+"""Compares kva.utils.get_latest_nonnull with the previous implementation, which applied a python
+function to every column of every group, on synthetic runs that are indexed by step.
+
+    python examples/benchmark_latest.py [rows]
+"""
+import random
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from kva.utils import _deep_merge, get_latest_nonnull
+
+
+class Container:
+    def __init__(self, val):
+        self.val = val
+
+
+def get_latest_nonnull_reference(df, index, columns, deep_merge=False):
+    if isinstance(index, str):
+        index = [index]
+    for col in index:
+        df[col] = df[col].apply(lambda x: 'None' if pd.isnull(x) else x)
+    columns = [col for col in columns if col in df.columns]
+    index = [col for col in index if col in df.columns]
+    if not index or not columns:
+        return pd.DataFrame()
+
+    def last_non_null(series):
+        if not deep_merge:
+            val = series.dropna().iloc[-1] if not series.dropna().empty else None
+            return Container(val) if isinstance(val, dict) else val
+        vals = series.dropna().tolist()
+        if not vals:
+            return None
+        current = vals[0]
+        for val in vals[1:]:
+            current = _deep_merge(current, val)
+        return Container(current) if isinstance(current, dict) else current
+
+    result = df.groupby(index)[columns].apply(lambda x: x.apply(last_non_null))
+    return result.map(lambda val: val.val if isinstance(val, Container) else val)
+
+
+def synthetic_run(rows, seed=0):
+    """Rows like a training loop logs them: metrics every step, evals and configs every few steps."""
+    rng = random.Random(seed)
+    data = []
+    for i in range(rows):
+        step = i // 3
+        kind = i % 3
+        if kind == 0:
+            data.append({'step': step, 'loss': rng.random(), 'lr': 1e-3})
+        elif kind == 1:
+            data.append({'step': step, 'grad_norm': rng.random() if rng.random() < 0.9 else None})
+        elif step % 10 == 0:
+            data.append({'step': step, 'eval': {'acc': rng.random(), 'split': {'name': rng.choice('ab')}}})
+        else:
+            data.append({'step': step if rng.random() < 0.99 else None, 'note': rng.choice(['x', 1, None])})
+    return pd.DataFrame(data)
+
+
+def benchmark(rows):
+    df = synthetic_run(rows)
+    columns = ['loss', 'lr', 'grad_norm', 'eval', 'note']
+    for deep_merge in (False, True):
+        timings = []
+        results = []
+        for implementation in (get_latest_nonnull_reference, get_latest_nonnull):
+            # Both implementations may modify the dataframe and the reference modifies the dicts in it
+            frame = pd.DataFrame(df.to_dict('records')) if deep_merge else df.copy()
+            start = time.time()
+            results.append(implementation(frame, 'step', columns, deep_merge=deep_merge))
+            timings.append(time.time() - start)
+        # The reference returns None or NaN for groups without values depending on the other columns
+        results = [result.where(result.notna(), np.nan) for result in results]
+        pd.testing.assert_frame_equal(results[0], results[1])
+        print(f"rows={rows} deep_merge={deep_merge}: reference {timings[0]:.3f}s, vectorized {timings[1]:.3f}s "
+              f"({timings[0] / timings[1]:.0f}x)")
+
+
+if __name__ == "__main__":
+    np.random.seed(0)
+    for rows in [int(sys.argv[1])] if len(sys.argv) > 1 else [1_000, 10_000, 100_000]:
+        benchmark(rows)
@@ -3,12 +3,64 @@ import axios from 'axios';
 import TablePanel from './TablePanel';
 import Papa from 'papaparse';
 
+const isTable = (filename) => filename.endsWith('.csv') || filename.endsWith('.parquet');
+
+const isLogFile = (path) => path.startsWith('artifacts/logfiles/');
+const tailLines = 500;
+const tailInterval = 2000;
+
+// Shows the last lines of a log file that is being written, and requests only what was appended since
+const LogTail = ({ path }) => {
+  const [text, setText] = useState('');
+
+  useEffect(() => {
+    let next = null;
+    let cancelled = false;
+    let pending = false;
+    const poll = () => {
+      if (pending) return;
+      pending = true;
+      const params = next === null ? { lines: tailLines } : { offset: next };
+      axios.get(`/${path}/tail`, { params })
+        .then(response => {
+          if (cancelled) return;
+          // The log was truncated or replaced, start again from its end
+          const restarted = next !== null && response.data.offset < next;
+          next = response.data.next;
+          if (restarted) {
+            next = null;
+            setText('');
+          } else if (response.data.text) {
+            setText(current => current + response.data.text);
+          }
+        })
+        .catch(error => {
+          console.error('There was an error fetching the log file!', error);
+        })
+        .finally(() => {
+          pending = false;
+        });
+    };
+    poll();
+    const interval = setInterval(poll, tailInterval);
+    return () => {
+      cancelled = true;
+      clearInterval(interval);
+    };
+  }, [path]);
+
+  return <pre style={{ maxHeight: '400px', overflow: 'auto' }}>{text}</pre>;
+};
+
 const FilePanel = ({ data }) => {
   const [csvData, setCsvData] = useState(null);
 
   useEffect(() => {
-    if (data.filename.endsWith('.csv')) {
-      axios.get(`/${data.path}`)
+    if (isTable(data.filename)) {
+      // Parquet tables and segments of appended tables are converted to CSV by the server
+      const converted = data.filename.endsWith('.parquet') || data.filename.includes('.segment.');
+      const url = converted ? `/${data.path}?format=csv` : `/${data.path}`;
+      axios.get(url)
         .then(response => {
           Papa.parse(response.data, {
             header: true,
@@ -32,10 +84,14 @@ const FilePanel = ({ data }) => {
       return <TablePanel data={csvData} />;
     }
 
-    if (data.filename.endsWith('.csv')) {
+    if (isTable(data.filename)) {
       return <div>Loading CSV data...</div>;
     }
 
+    if (isLogFile(data.path)) {
+      return <LogTail path={data.path} />;
+    }
+
     const filePath = `/${data.path}`;
     const fileExtension = data.filename.split('.').pop().toLowerCase();
 
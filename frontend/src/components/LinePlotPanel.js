@@ -1,37 +1,75 @@
-import React from 'react';
+import React, { useState } from 'react';
+import axios from 'axios';
 import {
-  LineChart, Line, XAxis, YAxis, CartesianGrid, Tooltip, Legend, ResponsiveContainer
+  LineChart, Line, XAxis, YAxis, CartesianGrid, Tooltip, Legend, ResponsiveContainer, ReferenceArea
 } from 'recharts';
 
 const colors = ["#8884d8", "#82ca9d", "#ffc658", "#ff7300", "#387908", "#e8c3b9", "#d0ed57", "#8e44ad", "#3498db"];
 
-const LinePlotPanel = ({ data, index }) => {
+// The server downsamples long lines. Dragging over the plot fetches the selected range, which has fewer points to downsample.
+// The zoomed range is not updated when new rows are pushed.
+const LinePlotPanel = ({ data, index, path, name, rows }) => {
+  const [zoomed, setZoomed] = useState(null);
+  const [selection, setSelection] = useState(null);
+
+  const shown = zoomed ? zoomed.data : data;
   const keys = Object.keys(data[0] || {}).filter(key => key !== index);
+  const numeric = typeof (data[0] || {})[index] === 'number';
+
+  const zoom = () => {
+    if (!selection || selection[1] === undefined || selection[0] === selection[1] || !path) {
+      setSelection(null);
+      return;
+    }
+    const [xMin, xMax] = selection[0] < selection[1] ? selection : [selection[1], selection[0]];
+    setSelection(null);
+    axios.get(`/data/${path}`, { params: { panel: name, x_min: xMin, x_max: xMax } })
+      .then(response => {
+        setZoomed(response.data[name] || { data: [], rows: 0 });
+      })
+      .catch(error => {
+        console.error('There was an error fetching the zoomed data!', error);
+      });
+  };
 
   return (
-    <ResponsiveContainer width="100%" height={400}>
-      <LineChart
-        data={data}
-        margin={{
-          top: 5, right: 30, left: 20, bottom: 5,
-        }}
-      >
-        <CartesianGrid strokeDasharray="3 3" />
-        <XAxis dataKey={index} />
-        <YAxis />
-        <Tooltip />
-        <Legend />
-        {keys.map((key, idx) => (
-          <Line 
-            key={key} 
-            type="monotone" 
-            dataKey={key} 
-            stroke={colors[idx % colors.length]} 
-            activeDot={{ r: 8 }} 
-          />
-        ))}
-      </LineChart>
-    </ResponsiveContainer>
+    <div>
+      {zoomed && <button onClick={() => setZoomed(null)}>Reset zoom</button>}
+      {(zoomed ? zoomed.rows : rows) > shown.length && (
+        <span> Showing {shown.length} of {zoomed ? zoomed.rows : rows} points, drag to zoom in</span>
+      )}
+      <ResponsiveContainer width="100%" height={400}>
+        <LineChart
+          data={shown}
+          margin={{
+            top: 5, right: 30, left: 20, bottom: 5,
+          }}
+          onMouseDown={e => e && setSelection([e.activeLabel])}
+          onMouseMove={e => e && selection && setSelection([selection[0], e.activeLabel])}
+          onMouseUp={zoom}
+        >
+          <CartesianGrid strokeDasharray="3 3" />
+          <XAxis dataKey={index} type={numeric ? 'number' : 'category'} domain={['dataMin', 'dataMax']} />
+          <YAxis />
+          <Tooltip />
+          <Legend />
+          {keys.map((key, idx) => (
+            <Line 
+              key={key} 
+              type="monotone" 
+              dataKey={key} 
+              stroke={colors[idx % colors.length]} 
+              activeDot={{ r: 8 }} 
+              dot={shown.length < 200}
+              isAnimationActive={false}
+            />
+          ))}
+          {selection && selection[1] !== undefined && (
+            <ReferenceArea x1={selection[0]} x2={selection[1]} strokeOpacity={0.3} />
+          )}
+        </LineChart>
+      </ResponsiveContainer>
+    </div>
   );
 };
 
@@ -2,7 +2,7 @@ import React, { useState } from 'react';
 import PanelTypeSwitch from './PanelTypeSwitch';
 import '../styles.css';
 
-const Panel = ({ name, data, type, index, slider }) => {  // Add slider as a prop
+const Panel = ({ name, data, type, index, slider, rows, path }) => {  // Add slider as a prop
   const [isOpen, setIsOpen] = useState(true);
 
   const togglePanel = () => {
@@ -21,6 +21,9 @@ const Panel = ({ name, data, type, index, slider }) => {  // Add slider as a pro
           type={type} 
           index={index} 
           slider={slider} 
+          rows={rows}
+          path={path}
+          name={name}
         />
       )}
     </div>
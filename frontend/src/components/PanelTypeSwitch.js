@@ -6,7 +6,7 @@ import FilePanel from './FilePanel';
 import SliderPanel from './SliderPanel';  // Import the new SliderPanel
 import '../styles.css';
 
-const PanelTypeSwitch = ({ data, type = 'data', index, slider, initiallyOpen = false }) => {  // Add slider as a prop
+const PanelTypeSwitch = ({ data, type = 'data', index, slider, initiallyOpen = false, rows, path, name }) => {  // Add slider as a prop
 
   if (slider) {
     return <SliderPanel data={data} slider={slider} type={type} index={index} />;
@@ -17,7 +17,7 @@ const PanelTypeSwitch = ({ data, type = 'data', index, slider, initiallyOpen = f
   console.log('type:', type)
   return (
     <div className={`panel-content`}>
-      {type === 'lineplot' && index && <LinePlotPanel data={data} index={index} />}
+      {type === 'lineplot' && index && <LinePlotPanel data={data} index={index} rows={rows} path={path} name={name} />}
       {type === 'data' && index && <TablePanel data={data} index={index} />}
       {type === 'data' && !index && <YamlPanel data={data} initiallyOpen={initiallyOpen} />}
       {type === 'image' && data && data.path && data.filename && <FilePanel data={data} />}
@@ -16,6 +16,13 @@ const RunDetails = () => {
       .catch(error => {
         console.error('There was an error fetching the run details!', error);
       });
+    // The server pushes the panels that change while the run is logging
+    const events = new EventSource(`/stream/${path}`);
+    events.onmessage = event => {
+      const update = JSON.parse(event.data);
+      setData(current => ({ ...current, ...update }));
+    };
+    return () => events.close();
   }, [path]);
 
   return (
@@ -32,6 +39,8 @@ const RunDetails = () => {
             type={panel.type} 
             index={panel.index} 
             slider={panel.slider}  // Pass the slider property
+            rows={panel.rows}
+            path={path}
           />
         );
       })}
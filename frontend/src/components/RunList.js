@@ -3,18 +3,27 @@ import { Link } from 'react-router-dom';
 import axios from 'axios';
 import '../styles.css';
 
+const pageSize = 500;
+
 const RunList = () => {
   const [runs, setRuns] = useState([]);
+  const [total, setTotal] = useState(0);
   const [searchTerm, setSearchTerm] = useState('');
 
-  useEffect(() => {
-    axios.get('/runs')
+  // The latest runs come first, older runs are loaded page by page
+  const loadRuns = offset => {
+    axios.get('/runs', { params: { order: 'desc', offset, limit: pageSize } })
       .then(response => {
-        setRuns(response.data.runs);
+        setRuns(current => (offset === 0 ? response.data.runs : [...current, ...response.data.runs]));
+        setTotal(response.data.total);
       })
       .catch(error => {
         console.error('There was an error fetching the runs!', error);
       });
+  };
+
+  useEffect(() => {
+    loadRuns(0);
   }, []);
 
   const filteredRuns = runs.filter(run => run.match(new RegExp(searchTerm, 'i')));
@@ -35,6 +44,7 @@ const RunList = () => {
           </li>
         ))}
       </ul>
+      {runs.length < total && <button onClick={() => loadRuns(runs.length)}>Load more runs</button>}
     </div>
   );
 };
@@ -1,26 +1,36 @@
 # kva/__init__.py
 
 import atexit
+import copy
 import hashlib
 import json
 import os
 import pickle
-import shutil
+import socket
 import subprocess
 import threading
+import time
 import uuid
+import weakref
 from contextlib import contextmanager
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Union
-from glob import glob
 from tqdm import tqdm
 from functools import lru_cache
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from itertools import compress
 
+import numpy as np
 import pandas as pd
 
+from kva.artifacts import artifact_store
+from kva.columnar import ColumnStore, LatestValues
+from kva.conditions import Condition, Eq, In, Range, Exists, And, Or
+from kva.formats import formats, get_format, merge_rows, segment_listing, segment_path, _timestamp
+from kva.index import ContextSummary, context_index, read_summary
 from kva.utils import (storage_path, set_storage, CustomJSONEncoder, File, LogFile, Folder, Table,
-                       _deep_merge, get_latest_nonnull, logger, KeyAwareDefaultDict)
+                       _deep_merge, get_latest_nonnull, logger, KeyAwareDefaultDict, to_json_native, _JSON_SCALARS,
+                       map_batched, parquet_available, locked_append, write_all)
 
 git_semaphore = threading.Semaphore()
 
@@ -38,20 +48,53 @@ def cached_load_json(path):
         return json.load(f)
 
 
-def load_jsonl(path):
-    if not os.path.exists(path):
-        return [], True
-    with open(path, 'r') as f:
-        return [json.loads(line) for line in f if line.strip()], False
+class Source:
+    """Class that syncs data & context to disk.
 
+    Appended rows are visible immediately and written to disk by a background thread once
+    `flush_rows` rows or `flush_bytes` bytes are pending, or at the latest after `flush_interval`
+    seconds. When `max_buffer_rows` rows are pending, `append` blocks until the writer caught up.
+
+    New data files are written in `storage_format` (see kva.formats), existing files keep their format.
+
+    If `writer` is set, rows are written to a segment file of the writer, {hash}.data.{writer}.jsonl, so that
+    processes that log to the same context don't wait for each other. 'auto' uses the host name and process id.
+    Rows of different files are merged by timestamp when they are read, `kva compact` merges the segments into the
+    data file."""
+    flush_rows = int(os.environ.get('KVA_FLUSH_ROWS', 1000))
+    flush_bytes = int(os.environ.get('KVA_FLUSH_BYTES', 1 << 20))
+    flush_interval = float(os.environ.get('KVA_FLUSH_INTERVAL', 5))
+    max_buffer_rows = int(os.environ.get('KVA_MAX_BUFFER_ROWS', 100000))
+    storage_format = os.environ.get('KVA_FORMAT', 'jsonl')
+    writer = os.environ.get('KVA_WRITER')
 
-class Source:
-    """Class that syncs data & context to disk."""
     def __init__(self, context, context_hash=None):
         self.context = context
-        self._context_hash = context_hash
-        self.saved, self.context_is_dirty = load_jsonl(self.data_path)
-        self.buffer = []
+        self._context_hash = context_hash or hashlib.sha256(json.dumps(context, sort_keys=True).encode()).hexdigest()
+        self.rows = []
+        self.format = get_format(self.storage_format)
+        for storage_format in formats.values():
+            if os.path.exists(self._data_path(storage_format)):
+                self.format = storage_format
+        self.context_is_dirty = not os.path.exists(self.context_path)
+        # Data file and segments -> (inode, position up to which the file has been read)
+        self._files = {}
+        self.buffer = [] # Rows encoded by self.format that are not yet written to disk
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Condition(self._lock)
+        self._drained = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._columns = ColumnStore()
+        self._latest = LatestValues(self.context)
+        self._columns_lock = threading.Lock()
+        self._summary = ContextSummary() # Of the rows written by this process
+        self._summary_checked = False # Whether the first write checked that the context has a summary
+        self.generation = 0 # Incremented whenever rows are added or replaced
+        if not self.context_is_dirty:
+            # New contexts have no data yet
+            self.refresh()
         atexit.register(self.write)
         data_sources[self.context_hash] = self
     
@@ -64,36 +107,228 @@ class Source:
     def from_hash(context_hash, context=None):
         if context_hash in data_sources:
             return data_sources[context_hash]
-        context = context or cached_load_json(os.path.join(storage_path(), f'{context_hash}.context.json'))
+        context = context or get_context(context_hash)
         return Source(context, context_hash)
     
     @property
     def data_path(self):
-        return os.path.join(storage_path(), f'{self.context_hash}.data.jsonl')
+        return self._data_path(self.format)
+
+    def _data_path(self, storage_format):
+        return os.path.join(storage_path(), f'{self.context_hash}{storage_format.suffix}')
+
+    @property
+    def context_path(self):
+        return os.path.join(storage_path(), f'{self.context_hash}.context.json')
+
+    @property
+    def write_path(self):
+        if not self.writer:
+            return self.data_path
+        writer = f"{socket.gethostname()}-{os.getpid()}" if self.writer == 'auto' else self.writer
+        return segment_path(self.data_path, writer)
+
+    def _paths(self):
+        """The data file and the segment files of this context."""
+        paths = [self.data_path] + segment_listing.get(self.data_path)
+        if self.writer and self.write_path not in paths:
+            paths.append(self.write_path)
+        return paths
     
     def append(self, data):
-        self.buffer.append(data)
+        self.extend([data])
+
+    def extend(self, rows):
+        """Append many rows. Rows are added in chunks that fit into the buffer."""
+        lines = [self.format.encode(row) for row in rows]
+        start = 0
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._flush_loop, daemon=True)
+                self._writer.start()
+            while start < len(rows):
+                while len(self.buffer) >= self.max_buffer_rows:
+                    self._flush_needed.notify()
+                    self._drained.wait()
+                end = min(len(rows), start + self.max_buffer_rows - len(self.buffer))
+                self.rows.extend(rows[start:end])
+                self.generation += 1
+                self.buffer.extend(lines[start:end])
+                self._buffer_bytes += sum(self.format.size(line) for line in lines[start:end])
+                if self._should_flush():
+                    self._flush_needed.notify()
+                start = end
+
+    def _should_flush(self):
+        return len(self.buffer) >= self.flush_rows or self._buffer_bytes >= self.flush_bytes
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                self._flush_needed.wait_for(self._should_flush, timeout=self.flush_interval)
+                if not self.buffer:
+                    # Idle writers exit, so that contexts that are no longer logged to don't keep a thread. `extend` starts a new one
+                    self._writer = None
+                    return
+            try:
+                self.write()
+            except Exception as e:
+                logger.error(f"Writing {self.data_path} failed: {e}")
+                time.sleep(self.flush_interval)
 
-    def write(self):
-        if not self.buffer:
+    def refresh(self):
+        """Read rows that have been appended to the data file since the last read, e.g. by another process."""
+        with self._write_lock:
+            self._read_appended()
+
+    def _read_appended(self, paths=None):
+        stats = {}
+        for path in paths or self._paths():
+            try:
+                stats[path] = os.stat(path)
+            except FileNotFoundError:
+                pass
+        if any(path not in stats or stats[path].st_ino != inode or stats[path].st_size < offset
+               for path, (inode, offset) in self._files.items() if paths is None or path in paths):
+            # A file has been replaced, truncated or removed: read all files from the start and keep unwritten rows
+            with self._lock:
+                pending = self.format.decode(self.buffer)
+            self._files = {}
+            self.rows = pending
+            self._columns = ColumnStore()
+            self._latest = LatestValues(self.context)
+            self.generation += 1
+        files = []
+        for path, stat in stats.items():
+            inode, offset = self._files.get(path, (stat.st_ino, None))
+            if stat.st_size == offset:
+                continue
+            rows, offset = self.format.load(path, offset or 0)
+            self._files[path] = (stat.st_ino, offset)
+            if rows:
+                files.append(rows)
+        if not files:
             return
-        if self.context_is_dirty:
-            with open(os.path.join(storage_path(), f'{self.context_hash}.context.json'), 'w') as f:
-                json.dump(self.context, f, indent=4)
-        with open(self.data_path, 'a') as f:
-            for row in self.buffer:
-                serialized = json.dumps(row)
-                f.write(serialized + '\n')
-        self.saved += self.buffer
-        self.buffer = []
+        rows = merge_rows(files)
+        with self._lock:
+            # Rows that we did not write yet come last, as they will also be written after these rows
+            end = at = len(self.rows) - len(self.buffer)
+            if len(self._files) > 1:
+                # Rows of other files are merged with the rows that have a later timestamp
+                first = min(map(_timestamp, rows))
+                while at > 0 and _timestamp(self.rows[at - 1]) > first:
+                    at -= 1
+                rows = merge_rows([self.rows[at:end], rows])
+            self.rows[at:end] = rows
+            if at < self._columns.n:
+                self._columns = ColumnStore()
+            if at < self._latest.n:
+                self._latest = LatestValues(self.context)
+            self.generation += 1
+
+    def write(self):
+        """Write all buffered rows to disk. Processes that write to the same file take turns via a file lock."""
+        with self._write_lock:
+            with self._lock:
+                has_rows = bool(self.buffer)
+            if not has_rows:
+                self._read_appended()
+                return
+            if self.context_is_dirty:
+                with open(self.context_path, 'w') as f:
+                    json.dump(self.context, f, indent=4)
+                context_index.add(self.context_hash, self.context)
+                self.context_is_dirty = False
+            path = self.write_path
+            with locked_append(path) as fd:
+                # Catch up with rows written by others to this file, so that our offset can skip the rows we write.
+                # Rows of other files are read on the next refresh
+                self._read_appended([path])
+                size = os.fstat(fd).st_size
+                offset = self._files.get(path, (None, 0))[1]
+                if size > offset:
+                    # Nobody else is writing, so this is the unfinished write of a process that crashed
+                    logger.warning(f"Removing {size - offset} bytes of an unfinished write from {path}")
+                    os.ftruncate(fd, offset)
+                with self._lock:
+                    lines, self.buffer, self._buffer_bytes = self.buffer, [], 0
+                    rows = self.rows[len(self.rows) - len(lines):]
+                    self._drained.notify_all()
+                try:
+                    write_all(fd, self.format.pack(lines))
+                except Exception:
+                    # Keep the rows buffered so that the next write can retry
+                    with self._lock:
+                        self.buffer[:0] = lines
+                        self._buffer_bytes += sum(self.format.size(line) for line in lines)
+                    raise
+                stat = os.fstat(fd)
+                self._files[path] = (stat.st_ino, stat.st_size)
+            if not self._summary_checked:
+                self._summary_checked = True
+                if not os.path.exists(ContextSummary.path(self.context_hash)):
+                    # Rows written before summaries existed are summarized together with ours. Rows that are still
+                    # buffered are summarized when they are written
+                    self._read_appended()
+                    with self._lock:
+                        rows = self.rows[:len(self.rows) - len(self.buffer)]
+            self._summary.append(self.context_hash, self._summary.add(rows))
+
+    def summary(self) -> ContextSummary:
+        """The summary of the rows of this context. Data that has been written without a summary is summarized once."""
+        summary = read_summary(self.context_hash)
+        if summary is None and self.data:
+            with self._write_lock:
+                summary = ContextSummary()
+                summary.append(self.context_hash, summary.add(self.data))
+                self._summary = summary
+        return summary
     
     @property
     def context_hash(self):
-        return hashlib.sha256(json.dumps(self.context, sort_keys=True).encode()).hexdigest()
+        return self._context_hash
     
     @property
     def data(self):
-        return self.saved + self.buffer
+        self.refresh()
+        return self.rows
+
+    @property
+    def columns(self) -> ColumnStore:
+        """Columnar copy of the rows (without context), extended with new rows on access.
+        Returns a snapshot, so that rows that are appended while it is used don't change its length."""
+        self.refresh()
+        with self._columns_lock:
+            columns = self._columns
+            columns.extend(self.rows[columns.n:])
+            return columns.snapshot()
+
+    def update_latest(self, latest: Dict[str, Any], columns: List[str], deep_merge: bool = True):
+        """Updates `latest` with the values of `columns` like DB.latest does when iterating over the rows of this source."""
+        self.refresh()
+        with self._columns_lock:
+            latest_values = self._latest
+            latest_values.extend(self.rows[latest_values.n:])
+            for column in columns:
+                latest_values.update(latest, column, deep_merge)
+
+    def frame(self, columns: List[str], mask: Optional[np.ndarray] = None, store: Optional[ColumnStore] = None) -> pd.DataFrame:
+        """Returns a dataframe of the rows (where mask is True) merged with the context, restricted to the existing `columns`."""
+        store = self.columns if store is None else store
+        n = len(store) if mask is None else int(mask.sum())
+        series = {}
+        for column in columns:
+            if column in store:
+                values = store.series(column, mask)
+                present = store.present(column) if mask is None else store.present(column)[mask]
+                if column in self.context and not present.all():
+                    values = values.astype(object)
+                    values[~present] = pd.Series([self.context[column]] * int((~present).sum()), index=values.index[~present])
+                    values = values.infer_objects()
+                series[column] = values
+            elif column in self.context:
+                series[column] = pd.Series([self.context[column]] * n)
+        return pd.DataFrame(series, index=pd.RangeIndex(n))
     
     def __iter__(self):
         return iter(self.data)
@@ -104,6 +339,16 @@ class Source:
 data_sources = KeyAwareDefaultDict(Source.from_hash)
 
 
+def get_context(context_hash):
+    """Returns the context of a context hash without loading its data."""
+    if context_hash in data_sources:
+        return data_sources[context_hash].context
+    context = context_index.get(context_hash)
+    if context is None:
+        context = cached_load_json(os.path.join(storage_path(), f'{context_hash}.context.json'))
+    return context
+
+
 class ForwardFill:
     def __init__(self, *columns):
         self.columns = columns
@@ -117,16 +362,57 @@ class ForwardFill:
                 data[c] = self.values[c]
         return data
 
+    def apply_columns(self, columns: Dict[str, List[Any]], n: int):
+        """Like `apply` for each of n rows given as lists of values per column."""
+        for c in self.columns:
+            values = columns.get(c)
+            if values is None:
+                columns[c] = [self.values[c]] * n
+                continue
+            if None in values:
+                values = columns[c] = list(values)
+                for i, value in enumerate(values):
+                    if value is None:
+                        values[i] = self.values[c]
+                    else:
+                        self.values[c] = value
+            elif n:
+                self.values[c] = values[-1]
+
+
+
+def _conditions_key(conditions):
+    """Returns a hashable key for a dict of conditions. Functions are compared by identity."""
+    return tuple((k, v.key if isinstance(v, Condition) else v) for k, v in sorted(conditions.items(), key=lambda item: item[0]))
+
+
+# (context_hash, conditions key) -> (generation, store token, number of resolved rows, resolved rows)
+_resolve_cache = OrderedDict()
+_resolve_cache_size = 256
+_resolve_lock = threading.Lock() # Views can be resolved from several threads, e.g. by the server
 
 
 @lru_cache
 def get_time_of_hash(context_hash):
-    return data_sources[context_hash].context.get('.run_started_at', datetime.now().isoformat())
+    return get_context(context_hash).get('.run_started_at', datetime.now().isoformat())
 
 class DB:
     """Logically an append only database that tracks data merged with context, and provides a few
     of all data that shares the same context."""
-    _views = []
+    # Views that are updated when contexts are created. Views that are no longer used are dropped
+    _views = weakref.WeakSet()
+    _view_cache = OrderedDict()
+    _view_cache_size = 256
+    _view_lock = threading.Lock()
+    _git_set_up = False
+    # 'copy', or 'link' to store artifacts as a reflink, hardlink or copy, whichever works first.
+    # Hardlinked artifacts change when the logged file is modified in place.
+    artifact_mode = os.environ.get('KVA_ARTIFACT_MODE', 'copy')
+    # With workers > 0, artifacts are stored in the background and `flush` waits for them.
+    # Logged files should not be modified until then.
+    artifact_workers = int(os.environ.get('KVA_ARTIFACT_WORKERS', 0))
+    # Logged dataframes are stored as parquet if pyarrow or fastparquet is installed, and as CSV otherwise
+    table_format = os.environ.get('KVA_TABLE_FORMAT', 'parquet' if parquet_available() else 'csv')
 
     def __init__(self, data_sources=None, context=default_context, conditions={}, dynamic_context={'timestamp': lambda: datetime.now().isoformat()}, forward_fill=None):
         self.dynamic_context = dynamic_context
@@ -139,23 +425,30 @@ class DB:
         
         # data_sources: (context_hash, row_level_conditions)
         self._data_sources = data_sources
-        self._indexed = set()
+        self._data_cache = None
+        # Context hashes that are already considered in self._data_sources
+        self._indexed = {context_hash for context_hash, _ in data_sources} if data_sources is not None else set()
+        # Position in the context index up to which contexts are considered in self._data_sources
+        self._index_position = None
         self.conditions = conditions
 
-        for view in self._views:
-            if self.context_hash in view._indexed:
+        with DB._view_lock:
+            views = list(DB._views)
+        for view in views:
+            if self.context_hash in view._indexed or view._data_sources is None:
+                # Views that did not load their data sources yet will find this context when they do
                 continue
             # For all other views, append (self, row_level_conditions) to their data_sources if needed
             accept_context, row_level_conditions = view.apply_conditions_to_context(self.context_hash)
             if accept_context:
-                if view._data_sources is None:
-                    breakpoint()
                 view._data_sources.append((self.context_hash, row_level_conditions))
             view._indexed.add(self.context_hash)
 
-        DB._views.append(self)
+        with DB._view_lock:
+            DB._views.add(self)
 
-        if len(DB._views) == 1:
+        if not DB._git_set_up:
+            DB._git_set_up = True
             self._setup_git()
             atexit.register(self._auto_sync)
     
@@ -163,20 +456,31 @@ class DB:
     def data_sources(self):
         """Lazy load data sources: data_sources is a list of (context_hash, row_level_conditions) that is used by .data"""
         if self._data_sources is not None:
+            # Contexts that have been created by other processes since
+            context_hashes, self._index_position = context_index.since(self._index_position)
+            self._add_sources(context_hashes)
             return self._data_sources
         self._data_sources = []
-        for context_file in glob(os.path.join(storage_path(), '*.context.json')):
-            context_hash = os.path.basename(context_file).replace('.context.json', '')
+        context_hashes, self._index_position = context_index.since()
+        # Contexts that have not been written to disk yet
+        context_hashes += [h for h in list(data_sources.keys()) if h not in context_index]
+        self._add_sources(context_hashes)
+        return self._data_sources
+
+    def _add_sources(self, context_hashes):
+        for context_hash in context_hashes:
+            if context_hash in self._indexed:
+                continue
+            self._indexed.add(context_hash)
             accept_context, row_level_conditions = self.apply_conditions_to_context(context_hash)
             if accept_context:
                 self._data_sources.append((context_hash, row_level_conditions))
-        return self._data_sources
     
     def apply_conditions_to_context(self, context_hash, conditions={}):
         """Loads the context for a given context_hash, then checks which conditions apply on context level
         and which apply on row level. Returns a tuple of (accept_context, row_level_conditions)."""
         conditions = dict(self.conditions, **conditions)
-        context = data_sources[context_hash].context
+        context = get_context(context_hash)
         accept_context = all([v(context[k]) for k, v in conditions.items() if k in context])
         if not accept_context:
             return False, {}
@@ -186,25 +490,126 @@ class DB:
     @property
     def context_hash(self):
         return self.logged_data.context_hash
+
+    def reload(self) -> 'DB':
+        """Discover contexts that have been created since the data sources were loaded, e.g. by another process.
+        Rows appended to known contexts are picked up automatically."""
+        context_index.reconcile()
+        self._data_sources = None
+        self._indexed = set()
+        self._index_position = None
+        return self
     
     # @lru_cache
     def resolve(self, context_hash, row_level_conditions):
-        rows = []
+        """Returns the rows of a context that pass the row level conditions, merged with the context.
+        Results are cached, and only rows that have been appended since are resolved when the source changes."""
         src = data_sources[context_hash]
-        for row in src.data:
-            if all([v(row.get(k)) for k, v in row_level_conditions.items()]):
-                rows.append(dict(src.context, **row))
-        return rows
+        key = (context_hash, _conditions_key(row_level_conditions))
+        with _resolve_lock:
+            cached = _resolve_cache.get(key)
+        src.refresh()
+        if cached is not None and cached[0] == src.generation:
+            with _resolve_lock:
+                if key in _resolve_cache:
+                    _resolve_cache.move_to_end(key)
+            return cached[3]
+        store = src.columns
+        if cached is not None and cached[1] is store.token:
+            # Rows have only been appended since the cached result
+            start, resolved = cached[2], list(cached[3])
+            store = store.snapshot(start)
+        else:
+            start, resolved = 0, []
+        rows = src.rows[start:store.n]
+        mask = self._row_mask(store, row_level_conditions)
+        if mask is not None:
+            rows = compress(rows, mask)
+        context = src.context
+        resolved += [{**context, **row} for row in rows]
+        with _resolve_lock:
+            _resolve_cache[key] = (src.generation, store.token, store.n, resolved)
+            _resolve_cache.move_to_end(key)
+            if len(_resolve_cache) > _resolve_cache_size:
+                _resolve_cache.popitem(last=False)
+        return resolved
+
+    def _resolved_sources(self):
+        """Returns the (context_hash, row_level_conditions) of all data in the order in which rows appear in .data"""
+        resolved = sorted(self.data_sources, key=lambda source: get_time_of_hash(source[0]))
+        if self.context_hash not in {context_hash for context_hash, _ in resolved}:
+            resolved.append((self.context_hash, {}))
+        return resolved
+
+    def state(self):
+        """A key of the sources of this view and their generations, which changes whenever rows are added to them.
+        Can be used to cache results that are derived from the data."""
+        sources = self._resolved_sources()
+        key = tuple((context_hash, _conditions_key(conditions)) for context_hash, conditions in sources)
+        generations = []
+        for context_hash, _ in sources:
+            src = data_sources[context_hash]
+            src.refresh()
+            generations.append(src.generation)
+        return key, tuple(generations)
 
     @property
     def data(self):
+        """All rows of this view. The list is cached until one of the sources changes and should not be modified."""
+        state = self.state()
+        if self._data_cache is not None and self._data_cache[0] == state:
+            return self._data_cache[1]
         rows = []
-        data_sources = sorted(self.data_sources, key=lambda source: get_time_of_hash(source[0]))
-        for context_hash, row_level_conditions in data_sources:
+        for context_hash, row_level_conditions in self._resolved_sources():
             rows += self.resolve(context_hash, row_level_conditions)
-        rows += self.logged_data.data
+        self._data_cache = (state, rows)
         return rows
 
+    def _row_mask(self, store, row_level_conditions):
+        if not row_level_conditions:
+            return None
+        mask = np.ones(len(store), dtype=bool)
+        # Declarative conditions are evaluated first, so that functions are only called for the remaining rows
+        for k, v in sorted(row_level_conditions.items(), key=lambda item: not isinstance(item[1], Condition)):
+            mask &= store.mask(k, v, where=mask)
+        return mask
+
+    def _frame(self, columns: List[str]) -> pd.DataFrame:
+        """Returns a dataframe with the given columns of .data, built from the columnar data of the sources."""
+        frames = []
+        for context_hash, row_level_conditions in self._resolved_sources():
+            src = data_sources[context_hash]
+            store = src.columns
+            df = src.frame(columns, self._row_mask(store, row_level_conditions), store)
+            if len(df) > 0:
+                frames.append(df)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+    def _columns(self) -> List[str]:
+        """Returns all columns of .data in order of their first appearance."""
+        columns = {}
+        for context_hash, row_level_conditions in self._resolved_sources():
+            src = data_sources[context_hash]
+            store = src.columns
+            mask = self._row_mask(store, row_level_conditions)
+            if len(store) == 0 or (mask is not None and not mask.any()):
+                continue
+            columns.update(dict.fromkeys(src.context))
+            if mask is None:
+                columns.update(dict.fromkeys(store.names))
+                continue
+            # Order the columns by their first appearance in the accepted rows
+            first_rows = {}
+            for column in store.names:
+                present = store.present(column) & mask
+                if present.any():
+                    first_rows[column] = int(present.argmax())
+            positions = {column: list(src.rows[row]).index(column) for column, row in first_rows.items()}
+            columns.update(dict.fromkeys(sorted(first_rows, key=lambda column: (first_rows[column], positions[column]))))
+        return list(columns)
+
 
     def init(self, **data: Dict[str, Any]) -> None:
         """Initialize a run with given context data."""
@@ -222,30 +627,76 @@ class DB:
         resolved.update(data)
         if self.forward_fill:
             resolved = self.forward_fill.apply(resolved)
+        processed_data = self._prepare(resolved)
+        self.logged_data.append(processed_data)
+        return processed_data
 
+    def log_many(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Log many rows at once. The dynamic context (e.g. the timestamp) is resolved once for all rows."""
+        dynamic = {k: v() for k, v in self.dynamic_context.items()}
+        processed_rows = []
+        for row in rows:
+            resolved = dict(dynamic)
+            resolved.update(row)
+            if self.forward_fill:
+                resolved = self.forward_fill.apply(resolved)
+            processed_rows.append(self._prepare(resolved))
+        self.logged_data.extend(processed_rows)
+        return processed_rows
+
+    def log_arrays(self, **arrays) -> List[Dict[str, Any]]:
+        """Log one row per element of equally long arrays, lists or tensors, e.g. `kva.log_arrays(step=np.arange(100), loss=losses)`.
+        Other values are logged in every row. The dynamic context is resolved once for all rows."""
+        columns, constants = {}, {}
+        for k, v in arrays.items():
+            values = v.tolist() if hasattr(v, 'tolist') else v
+            if isinstance(values, (list, tuple)):
+                columns[k] = values
+            else:
+                constants[k] = values
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"All arrays need to have the same length, got {({k: len(v) for k, v in columns.items()})}")
+        n = lengths.pop() if lengths else 1
+        for k, value in constants.items():
+            columns[k] = [value] * n
+        # Keep the order of the keywords
+        columns = {k: columns[k] for k in arrays}
+        if self.forward_fill:
+            self.forward_fill.apply_columns(columns, n)
+        dynamic = {k: v() for k, v in self.dynamic_context.items()}
+        names = [*dynamic, *columns]
+        rows = [dict(zip(names, (*dynamic.values(), *values))) for values in zip(*columns.values())]
+        if all(type(value) in _JSON_SCALARS for values in [*columns.values(), dynamic.values()] for value in values):
+            # E.g. numeric arrays: the rows consist of json types already
+            processed_rows = rows
+        else:
+            processed_rows = [self._prepare(row) for row in rows]
+        self.logged_data.extend(processed_rows)
+        return processed_rows
+
+    def _prepare(self, resolved: Dict[str, Any]) -> Dict[str, Any]:
+        """Stores the files of a row and converts its values to json types."""
         def process_file(value):
             if isinstance(value, File):
                 return self._handle_file(value)
+            elif isinstance(value, Folder):
+                return self._handle_folder(value)
             elif isinstance(value, LogFile):
                 value.report_context = resolved
                 return self._handle_logfile(value)
             elif isinstance(value, pd.DataFrame):
                 return self._handle_dataframe(value)
-            elif isinstance(value, dict):
-                return {k: process_file(v) for k, v in value.items()}
-            elif isinstance(value, list):
-                return [process_file(v) for v in value]
-            else:
-                return value
+            return value
 
-        processed_data = {k: process_file(v) for k, v in resolved.items()}
+        # Files are stored and other values converted to json types in one pass, the row is serialized once by the source
+        return to_json_native(resolved, process_file)
 
-        # Apply the CustomJSONEncoder to the processed data but don't convert to string yet
-        processed = json.dumps(processed_data, cls=CustomJSONEncoder)
-        processed_data = json.loads(processed)
-
-        self.logged_data.append(processed_data)
-        return processed_data
+    def flush(self) -> None:
+        """Write all buffered rows of all sources and all pending artifacts to disk."""
+        for source in list(data_sources.values()):
+            source.write()
+        artifact_store.wait()
 
     def _handle_logfile(self, logfile: LogFile) -> Dict[str, Any]:
         """Handle LogFile without storing immediately."""
@@ -267,62 +718,174 @@ class DB:
         os.makedirs(dest_dir, exist_ok=True)
 
         dest_path = os.path.join(dest_dir, os.path.basename(file.src))
-        if not os.path.exists(dest_path):
-            shutil.copy(file.src, dest_path)
+        artifact_store.store(file.src, dest_path, self.artifact_mode, self.artifact_workers)
         file.path = os.path.relpath(dest_path, storage_path())
         file.base_path = storage_path()
 
-        return {
+        data = {
             'src': file.src,
             'path': file.path,
             'hash': file.hash,
             'filename': os.path.basename(file.src)
         }
+        if 'hash_algorithm' in file:
+            data['hash_algorithm'] = file['hash_algorithm']
+        return data
+
+    def _handle_folder(self, folder: Folder) -> Dict[str, Any]:
+        """Handle the files of a folder like `_handle_file`, on `folder.workers` threads. Returns the nested dicts of the files."""
+        tree = {}
+        handled = []
+        def copy_structure(folder, result):
+            for name, value in folder.items():
+                if isinstance(value, Folder):
+                    result[name] = {}
+                    copy_structure(value, result[name])
+                else:
+                    result[name] = None
+                    handled.append((result, name, value))
+        copy_structure(folder, tree)
+        files = map_batched(lambda file: self._handle_file(file) if isinstance(file, File) else file,
+                            [file for _, _, file in handled], folder.workers, f"Storing {folder.path}", folder.progress)
+        for (result, name, _), file in zip(handled, files):
+            result[name] = file
+        return tree
 
     def _handle_dataframe(self, df: pd.DataFrame) -> Dict[str, Any]:
-        """Handle DataFrame storage as CSV and return a dictionary for logging."""
+        """Handle DataFrame storage as parquet (or CSV) and return a dictionary for logging. Tables that have been
+        logged before and to which rows have been added since are stored as a segment of the new rows."""
         artifacts_dir = os.path.join(storage_path(), 'artifacts')
         os.makedirs(artifacts_dir, exist_ok=True)
 
-        file_hash = hashlib.sha256(pd.util.hash_pandas_object(df, index=True).values).hexdigest()
+        row_hashes = pd.util.hash_pandas_object(df, index=True).values
+        # Tables with the same values but different columns or dtypes are different tables
+        schema = json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode()
+        segment = df._segment if isinstance(df, Table) else None
+        if (segment is not None and len(df) >= segment['rows'] and list(df.columns) == segment['columns']
+                and hashlib.sha256(schema + row_hashes[:segment['rows']].tobytes()).hexdigest() == segment['prefix']):
+            if len(df) == segment['rows']:
+                return dict(segment['data'])
+            previous = segment['data']
+            file_hash = hashlib.sha256(previous['hash'].encode() + row_hashes[segment['rows']:].tobytes()).hexdigest()
+            name, rows = 'table.segment', df.iloc[segment['rows']:]
+        else:
+            previous = None
+            file_hash = hashlib.sha256(schema + row_hashes.tobytes()).hexdigest()
+            name, rows = 'table', df
         dest_dir = os.path.join(artifacts_dir, file_hash)
         os.makedirs(dest_dir, exist_ok=True)
 
-        filename = f"table.csv"
+        # Tables are stored by their hash, so a table that has been stored before doesn't need to be written again
+        existing = [filename for filename in (f"{name}.parquet", f"{name}.csv") if os.path.exists(os.path.join(dest_dir, filename))]
+        filename = existing[0] if existing else self._write_table(rows, dest_dir, name)
         dest_path = os.path.join(dest_dir, filename)
-        df.to_csv(dest_path, index=False)
 
-        return {
+        data = {
             'path': os.path.relpath(dest_path, storage_path()),
             'hash': file_hash,
             'filename': filename
         }
+        if previous is not None:
+            previous_path = os.path.relpath(os.path.join(storage_path(), previous['path']), dest_dir)
+            with open(os.path.join(dest_dir, 'segment.json'), 'w') as f:
+                json.dump({'previous': previous_path, 'rows': len(df)}, f)
+            data.update(previous=previous['path'], rows=len(df))
+        if isinstance(df, Table):
+            df._segment = {'data': data, 'rows': len(df), 'prefix': hashlib.sha256(schema + row_hashes.tobytes()).hexdigest(), 'columns': list(df.columns)}
+        return data
+
+    def _write_table(self, df: pd.DataFrame, dest_dir: str, name: str = "table") -> str:
+        """Writes a table in `table_format` and returns its filename. Tables that parquet can't store (e.g. with
+        columns of mixed types) are written as CSV."""
+        if self.table_format == 'parquet':
+            tmp = os.path.join(dest_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+            try:
+                df.to_parquet(tmp, index=False)
+                os.replace(tmp, os.path.join(dest_dir, f"{name}.parquet"))
+                return f"{name}.parquet"
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Storing the table as CSV, as it can't be stored as parquet: {e}")
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        tmp = os.path.join(dest_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, os.path.join(dest_dir, f"{name}.csv"))
+        return f"{name}.csv"
 
     def filter(self, conditions, new_context={}) -> 'DB':
-        """Filter rows based on a dict of functions."""
+        """Filter rows based on a dict of conditions: each value is a `kva.Condition` (`Eq`, `In`, `Range`, `Exists`,
+        `And`, `Or`) or a function that accepts or rejects the value of a key.
+        Views that are filtered only by declarative conditions are cached by the key of their conditions. Each call
+        returns a copy of the cached view that shares its data sources, as `init` and `context` change the view."""
+        view_key = self._view_key(conditions, new_context)
+        with DB._view_lock:
+            cached = DB._view_cache.get(view_key)
+            if cached is not None:
+                DB._view_cache.move_to_end(view_key)
+        if cached is not None:
+            return self._copy_view(cached[0])
         # Iterate over context files
         # Apply all conditions for keys in the context files
         # If they all pass, load the data and apply remaining conditions to rows
 
+        # The context index rejects contexts with the wrong values, contexts that are not in the index have not been written yet
+        candidates = context_index.candidates(conditions)
         filtered_data_sources = []
-        for context_hash, row_level_conditions in self.data_sources + [(self.context_hash, {})]:
+        sources = self.data_sources
+        if self.context_hash not in {context_hash for context_hash, _ in sources}:
+            sources = sources + [(self.context_hash, {})]
+        for context_hash, row_level_conditions in sources:
+            if candidates is not None and context_hash not in candidates and context_hash in context_index and context_hash != self.context_hash:
+                continue
             accept_context, new_row_level_conditions = self.apply_conditions_to_context(context_hash, conditions)
             if accept_context:
                 filtered_data_sources.append((context_hash, new_row_level_conditions))
         combined_conditions = dict(self.conditions, **conditions)
         new_context = {**self.logged_data.context, **new_context}
-        return DB(filtered_data_sources, new_context, combined_conditions, forward_fill=self.forward_fill)
+        view = DB(filtered_data_sources, new_context, combined_conditions, forward_fill=self.forward_fill)
+        # The view considered the same contexts of the index, later contexts are added when its data sources are accessed
+        view._index_position = self._index_position
+        if view_key is not None:
+            with DB._view_lock:
+                # Keep a reference to the data sources, so that their id is not reused for a different list
+                DB._view_cache[view_key] = (view, self._data_sources)
+                if len(DB._view_cache) > DB._view_cache_size:
+                    DB._view_cache.popitem(last=False)
+            return self._copy_view(view)
+        return view
+
+    @staticmethod
+    def _copy_view(view: 'DB') -> 'DB':
+        """A copy of a cached view that shares its data sources, and is updated like them when contexts are created."""
+        view = copy.copy(view)
+        with DB._view_lock:
+            DB._views.add(view)
+        return view
+
+    def _view_key(self, conditions, new_context):
+        """Returns a key that identifies the result of self.filter(conditions, new_context), or None if it can't be cached.
+        Contexts that are created later are added to all views in DB.__init__, so the key doesn't depend on them."""
+        if not all(isinstance(condition, Condition) for condition in list(self.conditions.values()) + list(conditions.values())):
+            return None
+        try:
+            context_key = json.dumps({**self.logged_data.context, **new_context}, sort_keys=True)
+        except TypeError:
+            return None
+        return (
+            _conditions_key(self.conditions), _conditions_key(conditions), context_key,
+            id(self.data_sources), id(self.forward_fill)
+        )
 
-    
     def get(self, **context: Dict[str, Any]) -> 'DB':
         """Get a subset of the data based on conditions."""
-        condition = {k: lambda v: v == context[k] for k in context}
+        condition = {k: Eq(v) for k, v in context.items()}
         return self.filter(condition, context)
 
     def latest(self, columns: Union[str, List[str]], index: Optional[str] = None, deep_merge: bool = True, keep_rows_without_values=False, replace_files=True) -> Union[Dict[str, Any], pd.DataFrame]:
         """Get the latest values for the specified columns."""
         if columns == '*':
-            columns = pd.DataFrame(self.data).columns
+            columns = self._columns()
             
         single_column = None
         if isinstance(columns, str):
@@ -330,7 +893,8 @@ class DB:
             columns = [columns]
 
         if index:
-            df = pd.DataFrame(self.data)
+            index_columns = [index] if isinstance(index, str) else list(index)
+            df = self._frame(list(dict.fromkeys(index_columns + list(columns))))
             if (isinstance(index, str) and index not in df.columns) or (isinstance(index, list) and not all(i in df.columns for i in index)):
                 # We return an empty dataframe if the index column is not present
                 print(f"Index column '{index}' not found in the data.")
@@ -345,14 +909,19 @@ class DB:
             return df
 
         latest_data = {}
-        for row in self.data:
-            for column in columns:
-                if column not in row:
-                    continue
-                if deep_merge:
-                    latest_data[column] = _deep_merge(latest_data.get(column, {}), row.get(column, {}))
-                else:
-                    latest_data[column] = row.get(column, latest_data.get(column))
+        for context_hash, row_level_conditions in self._resolved_sources():
+            if not row_level_conditions:
+                # Unfiltered sources keep their latest values up to date, so we don't need to iterate over their rows
+                data_sources[context_hash].update_latest(latest_data, columns, deep_merge)
+                continue
+            for row in self.resolve(context_hash, row_level_conditions):
+                for column in columns:
+                    if column not in row:
+                        continue
+                    if deep_merge:
+                        latest_data[column] = _deep_merge(latest_data.get(column, {}), row.get(column, {}))
+                    else:
+                        latest_data[column] = row.get(column, latest_data.get(column))
 
         latest_data = self._replace_files(latest_data)
 
@@ -444,6 +1013,15 @@ def init(**data: Dict[str, Any]) -> DB:
 def log(data: Dict[str, Any]={}, **more_data):
     kva.log(data, **more_data)
 
+def log_many(rows: List[Dict[str, Any]]):
+    kva.log_many(rows)
+
+def log_arrays(**arrays):
+    kva.log_arrays(**arrays)
+
+def flush() -> None:
+    kva.flush()
+
 def get(**conditions: Dict[str, Any]) -> 'DB':
     return kva.get(**conditions)
 
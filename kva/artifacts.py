@@ -0,0 +1,98 @@
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict
+
+from kva.utils import logger
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+FICLONE = 0x40049409 # Linux ioctl that makes dst share the blocks of src until either is modified
+
+
+def _reflink(src: str, dst: str):
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def store_file(src: str, dest: str, mode: str = 'copy') -> str:
+    """Stores a file at `dest`, unless it exists already. With mode 'link', a reflink is tried first, then a
+    hardlink and then a copy. Hardlinked artifacts change when the source file is modified in place.
+    The file appears at `dest` only once it is complete. Returns how the file was stored."""
+    if os.path.exists(dest):
+        return 'exists'
+    tmp = f"{dest}.{uuid.uuid4().hex}.tmp"
+    method = 'copy'
+    try:
+        if mode == 'link':
+            for method, link in (('reflink', _reflink), ('hardlink', os.link)):
+                try:
+                    link(src, tmp)
+                    break
+                except OSError:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+            else:
+                method = 'copy'
+        if method == 'copy':
+            shutil.copy(src, tmp)
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return method
+
+
+class ArtifactStore:
+    """Stores files in the artifacts directory, on a pool of `workers` background threads if workers > 0.
+    Files that are being stored are tracked until they are stored, or until `wait` is called if storing them failed."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._workers = 0
+        self.pending: Dict[str, object] = {} # dest -> future
+
+    def store(self, src: str, dest: str, mode: str = 'copy', workers: int = 0):
+        if workers <= 0:
+            store_file(src, dest, mode)
+            return
+        with self._lock:
+            if dest in self.pending:
+                return
+            if self._pool is None or self._workers != workers:
+                if self._pool is not None:
+                    # Files that were submitted to the old pool are still stored and stay pending, its threads exit after them
+                    self._pool.shutdown(wait=False)
+                self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kva-artifacts')
+                self._workers = workers
+            future = self._pool.submit(store_file, src, dest, mode)
+            self.pending[dest] = future
+        future.add_done_callback(lambda future: self._done(src, dest, future))
+
+    def _done(self, src, dest, future):
+        if future.exception() is not None:
+            logger.error(f"Storing {src} at {dest} failed: {future.exception()}")
+            return
+        with self._lock:
+            if self.pending.get(dest) is future:
+                del self.pending[dest]
+
+    def wait(self):
+        """Waits until all pending files are stored. Raises the first error that occurred."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        wait(list(pending.values()))
+        for future in pending.values():
+            if future.exception() is not None:
+                raise future.exception()
+
+
+artifact_store = ArtifactStore()
@@ -0,0 +1,30 @@
+import sys
+
+from kva.formats import compact, convert, formats
+
+
+usage = f"""Usage: kva convert [{'|'.join(formats)}]
+       kva compact
+
+convert: Converts the data files in the storage (KVA_STORAGE) to another format, binary by default.
+         Don't log to the storage while converting it.
+compact: Merges the segment files that processes with KVA_WRITER write into the data files."""
+
+
+def main():
+    if sys.argv[1:] == ['compact']:
+        compacted = compact()
+        print(f"Merged segments into {len(compacted)} data files")
+        return
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != 'convert' or (len(sys.argv) == 3 and sys.argv[2] not in formats):
+        print(usage)
+        sys.exit(1)
+    to = sys.argv[2] if len(sys.argv) == 3 else 'binary'
+    converted = convert(to)
+    for path in converted:
+        print(f"Converted {path}")
+    print(f"Converted {len(converted)} data files to {to}")
+
+
+if __name__ == "__main__":
+    main()
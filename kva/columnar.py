@@ -0,0 +1,196 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from kva.utils import _deep_merge_tracked, _deep_merge_replayed
+
+
+class Column:
+    """Values of one column in a growable typed array. Rows that don't have the column are marked in `present`.
+
+    Values are stored as int64 as long as all values are ints, then as float64 as long as all values are
+    numbers, and as objects otherwise. None is stored as NaN in numeric columns."""
+    def __init__(self, capacity: int = 16):
+        self.kind = 'int'
+        self.values = np.zeros(capacity, dtype=np.int64)
+        self.present = np.zeros(capacity, dtype=bool)
+
+    def set(self, i: int, value: Any):
+        if i >= len(self.values):
+            self._grow(max(2 * len(self.values), i + 1))
+        if self.kind != 'object':
+            value_type = type(value)
+            if value_type is int and self.kind == 'int' and -2**63 <= value < 2**63:
+                pass
+            elif value_type in (int, float) and (value_type is float or abs(value) < 2**53):
+                self._convert('float')
+            elif value is None:
+                self._convert('float')
+                value = np.nan
+            else:
+                self._convert('object')
+        self.values[i] = value
+        self.present[i] = True
+
+    def _grow(self, capacity: int):
+        values = np.zeros(capacity, dtype=self.values.dtype)
+        values[:len(self.values)] = self.values
+        present = np.zeros(capacity, dtype=bool)
+        present[:len(self.present)] = self.present
+        self.values, self.present = values, present
+
+    def _convert(self, kind: str):
+        if kind == self.kind or self.kind == 'object':
+            return
+        if kind == 'float':
+            self.values = self.values.astype(np.float64)
+        else:
+            values = self.values.astype(object)
+            if self.kind == 'float':
+                # NaNs in float columns that are present were logged as None
+                values[np.isnan(self.values) & self.present] = None
+            self.values = values
+        self.kind = kind
+
+    def series(self, start: int, stop: int, mask: Optional[np.ndarray] = None) -> pd.Series:
+        """Returns the values of rows start:stop (where mask is True) with the dtype that pandas infers for a list
+        of dicts: rows without the column are NaN."""
+        values, present = self.values[start:stop], self.present[start:stop]
+        if mask is not None:
+            values, present = values[mask], present[mask]
+        if present.all():
+            if self.kind == 'object':
+                return pd.Series(values).infer_objects()
+            return pd.Series(values.copy())
+        if self.kind == 'object':
+            values = values.copy()
+            values[~present] = np.nan
+            return pd.Series(values).infer_objects()
+        values = values.astype(np.float64)
+        values[~present] = np.nan
+        return pd.Series(values)
+
+    def mask(self, start: int, stop: int, condition: Callable[[Any], bool], where: Optional[np.ndarray] = None) -> np.ndarray:
+        """Evaluates a condition on the values of rows start:stop, vectorized for numeric columns and declarative
+        conditions. Other conditions are only called for values where `where` is True, the mask is False elsewhere."""
+        if self.kind != 'object' and hasattr(condition, 'mask'):
+            values = self.values[start:stop]
+            null = ~self.present[start:stop]
+            if self.kind == 'float':
+                null |= np.isnan(values)
+            return condition.mask(values, null)
+        mask = np.zeros(stop - start, dtype=bool)
+        values = self.to_list(start, stop)
+        for i in (range(stop - start) if where is None else np.flatnonzero(where)):
+            mask[i] = bool(condition(values[i]))
+        return mask
+
+    def to_list(self, start: int, stop: int) -> List[Any]:
+        """Returns the values of rows start:stop as python objects, None for rows without the column."""
+        values = self.values[start:stop].astype(object) if self.kind != 'object' else self.values[start:stop].copy()
+        if self.kind == 'float':
+            values[np.isnan(self.values[start:stop])] = None
+        values[~self.present[start:stop]] = None
+        return values.tolist()
+
+
+class ColumnStore:
+    """Columnar representation of a list of rows (dicts) that is extended incrementally.
+
+    Snapshots of a store cover the rows start:n. They share the `token` of their store, which changes
+    when a store is rebuilt from scratch."""
+    def __init__(self):
+        self.start = 0
+        self.n = 0
+        self.columns: Dict[str, Column] = {}
+        self.token = object()
+
+    def __len__(self):
+        return self.n - self.start
+
+    def snapshot(self, start: int = 0) -> 'ColumnStore':
+        """Returns a store of the rows start:n that is not affected by rows that are added later."""
+        snapshot = ColumnStore()
+        snapshot.start = start
+        snapshot.n = self.n
+        snapshot.columns = dict(self.columns)
+        snapshot.token = self.token
+        return snapshot
+
+    def __contains__(self, name: str):
+        return name in self.columns
+
+    @property
+    def names(self) -> List[str]:
+        """Column names in order of their first appearance."""
+        return list(self.columns)
+
+    def extend(self, rows: List[Dict[str, Any]]):
+        columns = self.columns
+        capacity = max(16, 2 * (self.n + len(rows)))
+        for i, row in enumerate(rows, self.n):
+            for name, value in row.items():
+                column = columns.get(name)
+                if column is None:
+                    column = columns[name] = Column(capacity)
+                column.set(i, value)
+        self.n += len(rows)
+
+    def series(self, name: str, mask: Optional[np.ndarray] = None) -> pd.Series:
+        return self.columns[name].series(self.start, self.n, mask)
+
+    def mask(self, name: str, condition: Callable[[Any], bool], where: Optional[np.ndarray] = None) -> np.ndarray:
+        """Evaluates a condition on the values of a column, with None for rows that don't have the column."""
+        if name not in self.columns:
+            if where is not None and not where.any():
+                return np.zeros(len(self), dtype=bool)
+            return np.full(len(self), bool(condition(None)))
+        return self.columns[name].mask(self.start, self.n, condition, where)
+
+    def to_list(self, name: str) -> List[Any]:
+        if name not in self.columns:
+            return [None] * len(self)
+        return self.columns[name].to_list(self.start, self.n)
+
+    def present(self, name: str) -> np.ndarray:
+        return self.columns[name].present[self.start:self.n]
+
+
+class LatestValues:
+    """The latest value and the deep merged value of each column of a list of rows merged with a context,
+    extended incrementally so that `DB.latest` doesn't need to iterate over the rows."""
+    def __init__(self, context: Dict[str, Any]):
+        self.context = context
+        self.n = 0
+        self.last: Dict[str, Any] = {}
+        self.merged: Dict[str, Any] = {}
+        self.resets: Dict[str, set] = {}
+        # Context columns whose value is merged already and doesn't change the merged value when merged again
+        self._context_merged = set()
+
+    def _merge(self, column: str, value: Any):
+        self.last[column] = value
+        resets = self.resets.setdefault(column, set())
+        self.merged[column] = _deep_merge_tracked(self.merged.get(column, {}), value, resets)
+
+    def extend(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            for column, value in row.items():
+                self._merge(column, value)
+            for column, value in self.context.items():
+                if column in row:
+                    self._context_merged.discard(column)
+                elif column not in self._context_merged:
+                    self._merge(column, value)
+                    self._context_merged.add(column)
+        self.n += len(rows)
+
+    def update(self, latest: Dict[str, Any], column: str, deep_merge: bool = True):
+        """Updates `latest` like iterating over the rows in `DB.latest` would."""
+        if column not in self.last:
+            return
+        if deep_merge:
+            latest[column] = _deep_merge_replayed(latest.get(column, {}), self.merged[column], self.resets[column])
+        else:
+            latest[column] = self.last[column]
@@ -0,0 +1,211 @@
+import json
+from typing import Any, List, Optional
+
+import numpy as np
+
+
+def _value_key(value: Any):
+    """Returns a hashable key for a value, such that equal values have equal keys."""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('json', json.dumps(value, sort_keys=True, default=repr))
+
+
+def _is_number(value: Any) -> bool:
+    return type(value) in (int, float, bool)
+
+
+class Condition:
+    """A declarative condition on a single value. Conditions can be used like the functions accepted by
+    `DB.filter`, but unlike functions they can be evaluated on numeric arrays, looked up in the context
+    index and compared by their `key`.
+
+    Rows that don't have a key are checked with `value=None`."""
+    def __call__(self, value: Any) -> bool:
+        raise NotImplementedError
+
+    def mask(self, values: np.ndarray, null: np.ndarray) -> np.ndarray:
+        """Evaluates the condition on a numeric array, where `null` marks values that are None."""
+        return np.fromiter((self(None if n else v) for v, n in zip(values.tolist(), null)), dtype=bool, count=len(values))
+
+    @property
+    def values(self) -> Optional[List[Any]]:
+        """The values that are accepted, or None if they are not a finite set."""
+        return None
+
+    @property
+    def key(self) -> tuple:
+        raise NotImplementedError
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __eq__(self, other):
+        return isinstance(other, Condition) and self.key == other.key
+
+    def __and__(self, other: 'Condition') -> 'Condition':
+        return And(self, other)
+
+    def __or__(self, other: 'Condition') -> 'Condition':
+        return Or(self, other)
+
+
+class Eq(Condition):
+    """Accepts values that are equal to `value`."""
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __call__(self, value: Any) -> bool:
+        return bool(value == self.value)
+
+    def mask(self, values, null):
+        if self.value is None:
+            return null.copy()
+        if _is_number(self.value):
+            return (values == self.value) & ~null
+        return np.zeros(len(values), dtype=bool)
+
+    @property
+    def values(self):
+        return [self.value]
+
+    @property
+    def key(self):
+        return ('Eq', _value_key(self.value))
+
+    def __repr__(self):
+        return f"Eq({self.value!r})"
+
+
+class In(Condition):
+    """Accepts values that are equal to one of `values`."""
+    def __init__(self, values: List[Any]):
+        self._values = list(values)
+
+    def __call__(self, value: Any) -> bool:
+        return any(value == v for v in self._values)
+
+    def mask(self, values, null):
+        mask = np.zeros(len(values), dtype=bool)
+        for value in self._values:
+            mask |= Eq(value).mask(values, null)
+        return mask
+
+    @property
+    def values(self):
+        return self._values
+
+    @property
+    def key(self):
+        return ('In', tuple(_value_key(v) for v in self._values))
+
+    def __repr__(self):
+        return f"In({self._values!r})"
+
+
+class Range(Condition):
+    """Accepts values with `low <= value < high`. Either bound may be None."""
+    def __init__(self, low: Any = None, high: Any = None):
+        self.low = low
+        self.high = high
+
+    def __call__(self, value: Any) -> bool:
+        if value is None:
+            return False
+        try:
+            return (self.low is None or self.low <= value) and (self.high is None or value < self.high)
+        except TypeError:
+            return False
+
+    def mask(self, values, null):
+        if not all(bound is None or _is_number(bound) for bound in (self.low, self.high)):
+            return super().mask(values, null)
+        mask = ~null
+        if self.low is not None:
+            mask &= values >= self.low
+        if self.high is not None:
+            mask &= values < self.high
+        return mask
+
+    @property
+    def key(self):
+        return ('Range', _value_key(self.low), _value_key(self.high))
+
+    def __repr__(self):
+        return f"Range({self.low!r}, {self.high!r})"
+
+
+class Exists(Condition):
+    """Accepts all values except None."""
+    def __call__(self, value: Any) -> bool:
+        return value is not None
+
+    def mask(self, values, null):
+        return ~null
+
+    @property
+    def key(self):
+        return ('Exists',)
+
+    def __repr__(self):
+        return "Exists()"
+
+
+class And(Condition):
+    """Accepts values that are accepted by all `conditions`."""
+    def __init__(self, *conditions: Condition):
+        self.conditions = conditions
+
+    def __call__(self, value: Any) -> bool:
+        return all(condition(value) for condition in self.conditions)
+
+    def mask(self, values, null):
+        mask = np.ones(len(values), dtype=bool)
+        for condition in self.conditions:
+            mask &= condition.mask(values, null)
+        return mask
+
+    @property
+    def values(self):
+        for condition in self.conditions:
+            if condition.values is not None:
+                return [value for value in condition.values if self(value)]
+        return None
+
+    @property
+    def key(self):
+        return ('And',) + tuple(condition.key for condition in self.conditions)
+
+    def __repr__(self):
+        return f"And{self.conditions!r}"
+
+
+class Or(Condition):
+    """Accepts values that are accepted by any of `conditions`."""
+    def __init__(self, *conditions: Condition):
+        self.conditions = conditions
+
+    def __call__(self, value: Any) -> bool:
+        return any(condition(value) for condition in self.conditions)
+
+    def mask(self, values, null):
+        mask = np.zeros(len(values), dtype=bool)
+        for condition in self.conditions:
+            mask |= condition.mask(values, null)
+        return mask
+
+    @property
+    def values(self):
+        values = [condition.values for condition in self.conditions]
+        if any(v is None for v in values):
+            return None
+        return [value for v in values for value in v]
+
+    @property
+    def key(self):
+        return ('Or',) + tuple(condition.key for condition in self.conditions)
+
+    def __repr__(self):
+        return f"Or{self.conditions!r}"
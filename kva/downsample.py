@@ -0,0 +1,69 @@
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+def minmax(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Positions of the smallest and largest y in each of about points / 2 buckets of equally many values, and of
+    the first and last value. Keeps spikes that averaging would hide."""
+    n = len(y)
+    if points >= n:
+        return np.arange(n)
+    buckets = max(1, (points - 4) // 2)
+    width = n // buckets
+    main = y[:width * buckets].reshape(buckets, width)
+    offsets = np.arange(buckets) * width
+    selected = [[0, n - 1], offsets + main.argmin(axis=1), offsets + main.argmax(axis=1)]
+    if n > width * buckets:
+        # The values that don't fill a bucket
+        rest = y[width * buckets:]
+        selected.append(width * buckets + np.array([rest.argmin(), rest.argmax()]))
+    return np.unique(np.concatenate(selected))
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Positions selected by Largest-Triangle-Three-Buckets: the first and last point, and of each bucket the
+    point that forms the largest triangle with the previously selected point and the average of the next bucket."""
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    ends = np.append(edges[2:], n)
+    next_x = np.add.reduceat(x, edges[1:]) / (ends - edges[1:])
+    next_y = np.add.reduceat(y, edges[1:]) / (ends - edges[1:])
+    selected = np.empty(points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs((x[a] - next_x[i]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y[i] - y[a]))
+        a = start + int(areas.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+methods = {'minmax': minmax, 'lttb': lttb}
+
+
+def downsample(df: pd.DataFrame, points: int, method: str = 'minmax', columns: List[str] = None) -> pd.DataFrame:
+    """Selects about `points` rows per column of a dataframe that is indexed by the x values of a plot.
+    Rows are selected for each column separately, using only the rows where it has a numeric value."""
+    if points <= 0 or len(df) <= points:
+        return df
+    if method not in methods:
+        raise ValueError(f"Unknown downsampling method {method!r}, available methods: {', '.join(methods)}")
+    if pd.api.types.is_numeric_dtype(df.index):
+        x = df.index.to_numpy(dtype=float)
+    else:
+        x = np.arange(len(df), dtype=float)
+    selected = []
+    for column in columns or df.columns:
+        y = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+        positions = np.flatnonzero(np.isfinite(y) & np.isfinite(x))
+        if len(positions) == 0:
+            continue
+        selected.append(positions[methods[method](x[positions], y[positions], points)])
+    if not selected:
+        return df.iloc[:0]
+    return df.iloc[np.unique(np.concatenate(selected))]
@@ -0,0 +1,354 @@
+import heapq
+import json
+import os
+import re
+import struct
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack
+from glob import escape, glob
+from typing import Any, Dict, List, Tuple
+
+from kva.utils import _json_key, load_jsonl, locked_append, logger, storage_path, write_all
+
+
+class JsonlFormat:
+    """One json object per line. Human readable and git friendly, this is the default."""
+    name = 'jsonl'
+    suffix = '.data.jsonl'
+
+    def encode(self, row: Dict[str, Any]) -> str:
+        """Serializes a row when it is appended, the result is buffered until it is written."""
+        return json.dumps(row) + '\n'
+
+    def size(self, item: str) -> int:
+        return len(item)
+
+    def decode(self, items: List[str]) -> List[Dict[str, Any]]:
+        return [json.loads(item) for item in items]
+
+    def pack(self, items: List[str]) -> bytes:
+        return ''.join(items).encode()
+
+    def load(self, path: str, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        return load_jsonl(path, offset)
+
+
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_MAX_U16 = 2**16 - 1
+
+# Value types: tag -> struct code. None and bools are stored in the shape only, strings and other
+# values (as json) are stored as their length followed by the bytes after the fixed size values.
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _JSON = range(7)
+_CODES = {_INT: 'q', _FLOAT: 'd', _STR: 'I', _JSON: 'I'}
+_CONSTANTS = {_NONE: None, _TRUE: True, _FALSE: False}
+_TAGS = {int: _INT, float: _FLOAT, str: _STR}
+
+
+def _encode_value(value: Any) -> Tuple[int, Any]:
+    if value is None:
+        return _NONE, None
+    if value is True:
+        return _TRUE, None
+    if value is False:
+        return _FALSE, None
+    if isinstance(value, int) and -2**63 <= value < 2**63:
+        return _INT, int(value)
+    if isinstance(value, float):
+        return _FLOAT, float(value)
+    if isinstance(value, str):
+        return _STR, value.encode()
+    return _JSON, json.dumps(value).encode()
+
+
+class _Shape:
+    """The keys and value types of a row, decoded from a block."""
+    def __init__(self, fields: List[Tuple[str, int]]):
+        self.keys = [key for key, _ in fields]
+        self.struct = struct.Struct('<' + ''.join(_CODES.get(tag, '') for _, tag in fields))
+        self.fixed = all(tag in (_INT, _FLOAT) for _, tag in fields)
+        self.fields = []
+        i = 0
+        for key, tag in fields:
+            if tag in _CONSTANTS:
+                self.fields.append((key, tag, _CONSTANTS[tag]))
+            else:
+                self.fields.append((key, tag, i))
+                i += 1
+
+    def decode(self, data: bytes, pos: int) -> Tuple[Dict[str, Any], int]:
+        values = self.struct.unpack_from(data, pos)
+        pos += self.struct.size
+        if self.fixed:
+            return dict(zip(self.keys, values)), pos
+        row = {}
+        for key, tag, i in self.fields:
+            if tag in _CONSTANTS:
+                row[key] = i
+            elif tag == _INT or tag == _FLOAT:
+                row[key] = values[i]
+            else:
+                end = pos + values[i]
+                row[key] = data[pos:end].decode() if tag == _STR else json.loads(data[pos:end])
+                pos = end
+        return row, pos
+
+
+class BinaryFormat:
+    """Compact binary blocks of rows, one block per write. Each block starts with a dictionary of the keys
+    and of the row shapes (keys and value types) in the block, so that rows store only a shape id, the
+    numbers as int64/float64, and the bytes of strings and nested values (as json).
+
+    Block: b'B', u32 size of the rest of the block, u16 #keys, (u16 length, key)*,
+    u16 #shapes, (u16 #fields, (u16 key id, u8 type)*)*, u32 #rows, (u16 shape id, values)*"""
+    name = 'binary'
+    suffix = '.data.kvb'
+
+    def __init__(self):
+        self._structs = {} # shape -> (struct of the shape id and values, indices of the values that are bytes)
+
+    def encode(self, row: Dict[str, Any]) -> Tuple[tuple, tuple, int]:
+        if len(row) > _MAX_U16:
+            raise ValueError(f"Rows with more than {_MAX_U16} keys can't be stored in the binary format")
+        shape, values, size = [], [], 2
+        for key, value in row.items():
+            tag = _TAGS.get(type(value))
+            if tag is None or (tag == _INT and not -2**63 <= value < 2**63):
+                tag, value = _encode_value(value)
+            elif tag == _STR:
+                value = value.encode()
+            shape.append((key if type(key) is str else _json_key(key), tag))
+            if tag in _CODES:
+                values.append(value)
+                size += 8 if tag in (_INT, _FLOAT) else 4 + len(value)
+        return tuple(shape), tuple(values), size
+
+    def size(self, item) -> int:
+        return item[2]
+
+    def decode(self, items) -> List[Dict[str, Any]]:
+        rows, _ = self._load(self.pack(items))
+        return rows
+
+    def pack(self, items) -> bytes:
+        blocks = []
+        keys, shapes, rows = {}, {}, []
+        for shape, values, _ in items:
+            shape_id = shapes.get(shape)
+            if shape_id is None:
+                new_keys = {key for key, _ in shape if key not in keys}
+                if len(keys) + len(new_keys) > _MAX_U16 or len(shapes) == _MAX_U16:
+                    blocks.append(self._block(keys, shapes, rows))
+                    keys, shapes, rows = {}, {}, []
+                for key, _ in shape:
+                    keys.setdefault(key, len(keys))
+                shape_id = shapes[shape] = len(shapes)
+            packer, var = self._struct(shape)
+            if var:
+                fixed = [len(value) if i in var else value for i, value in enumerate(values)]
+                rows.append(packer.pack(shape_id, *fixed) + b''.join(values[i] for i in var))
+            else:
+                rows.append(packer.pack(shape_id, *values))
+        if rows:
+            blocks.append(self._block(keys, shapes, rows))
+        return b''.join(blocks)
+
+    def _struct(self, shape: tuple):
+        if shape not in self._structs:
+            if len(self._structs) > 10000:
+                self._structs.clear()
+            tags = [tag for _, tag in shape if tag in _CODES]
+            var = [i for i, tag in enumerate(tags) if tag in (_STR, _JSON)]
+            self._structs[shape] = (struct.Struct('<H' + ''.join(_CODES[tag] for tag in tags)), var)
+        return self._structs[shape]
+
+    def _block(self, keys: Dict[str, int], shapes: Dict[tuple, int], rows: List[bytes]) -> bytes:
+        parts = [_U16.pack(len(keys))]
+        for key in keys:
+            encoded = key.encode()
+            parts.append(_U16.pack(len(encoded)) + encoded)
+        parts.append(_U16.pack(len(shapes)))
+        for shape in shapes:
+            parts.append(_U16.pack(len(shape)))
+            parts.extend(_U16.pack(keys[key]) + _U8.pack(tag) for key, tag in shape)
+        parts.append(_U32.pack(len(rows)))
+        parts.extend(rows)
+        payload = b''.join(parts)
+        return b'B' + _U32.pack(len(payload)) + payload
+
+    def load(self, path: str, offset: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        """Parses the complete blocks of a file starting at a byte offset.
+        Returns (rows, offset after the last complete block)."""
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        rows, end = self._load(data)
+        return rows, offset + end
+
+    def _load(self, data: bytes) -> Tuple[List[Dict[str, Any]], int]:
+        rows = []
+        pos = 0
+        while pos + 5 <= len(data):
+            if data[pos:pos + 1] != b'B':
+                raise ValueError(f"Invalid block at byte {pos}")
+            size, = _U32.unpack_from(data, pos + 1)
+            if pos + 5 + size > len(data):
+                break
+            rows += self._load_block(data, pos + 5)
+            pos += 5 + size
+        return rows, pos
+
+    def _load_block(self, data: bytes, pos: int) -> List[Dict[str, Any]]:
+        n, = _U16.unpack_from(data, pos)
+        pos += 2
+        keys = []
+        for _ in range(n):
+            length, = _U16.unpack_from(data, pos)
+            keys.append(data[pos + 2:pos + 2 + length].decode())
+            pos += 2 + length
+        n, = _U16.unpack_from(data, pos)
+        pos += 2
+        shapes = []
+        for _ in range(n):
+            length, = _U16.unpack_from(data, pos)
+            pos += 2
+            fields = []
+            for _ in range(length):
+                key_id, = _U16.unpack_from(data, pos)
+                tag, = _U8.unpack_from(data, pos + 2)
+                fields.append((keys[key_id], tag))
+                pos += 3
+            shapes.append(_Shape(fields))
+        n, = _U32.unpack_from(data, pos)
+        pos += 4
+        rows = []
+        for _ in range(n):
+            shape_id, = _U16.unpack_from(data, pos)
+            row, pos = shapes[shape_id].decode(data, pos + 2)
+            rows.append(row)
+        return rows
+
+
+formats = {format.name: format for format in (JsonlFormat(), BinaryFormat())}
+
+
+def get_format(name: str):
+    if name not in formats:
+        raise ValueError(f"Unknown storage format {name!r}, available formats: {', '.join(formats)}")
+    return formats[name]
+
+
+def segment_path(data_path: str, writer: str) -> str:
+    """The file that a writer writes to instead of the data file: {hash}.data.{writer}.jsonl"""
+    root, ext = os.path.splitext(data_path)
+    return f"{root}.{re.sub(r'[^A-Za-z0-9_-]', '_', writer)}{ext}"
+
+
+def segment_paths(data_path: str) -> List[str]:
+    root, ext = os.path.splitext(data_path)
+    return sorted(glob(f"{escape(root)}.*{ext}"))
+
+
+class SegmentListing:
+    """The segment files of all contexts in a directory, which is listed again when it changes. Shared by all sources,
+    so that the directory is listed once per change rather than once per context."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None # (directory, mtime) of the listing
+        self._segments = {} # name of a data file -> its segments
+
+    def get(self, data_path: str) -> List[str]:
+        directory, name = os.path.split(data_path)
+        try:
+            key = (directory, os.stat(directory).st_mtime_ns)
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            if key != self._key:
+                segments = defaultdict(list)
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        parts = entry.name.split('.')
+                        if len(parts) > 3 and parts[1] == 'data' and parts[-1] != 'tmp':
+                            segments[f"{parts[0]}.data.{parts[-1]}"].append(entry.path)
+                for paths in segments.values():
+                    paths.sort()
+                self._key, self._segments = key, segments
+            return self._segments.get(name, [])
+
+
+segment_listing = SegmentListing()
+
+
+def data_files(context_hash: str, path: str = None) -> List[str]:
+    """The data files and segments of a context in all formats."""
+    pattern = os.path.join(escape(path or storage_path()), f'{context_hash}.data.*')
+    return [file for file in glob(pattern) if not file.endswith('.tmp')]
+
+
+def _timestamp(row: Dict[str, Any]) -> str:
+    timestamp = row.get('timestamp')
+    return timestamp if isinstance(timestamp, str) else ''
+
+
+def merge_rows(files: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Merges the rows of several files by timestamp, rows of one file keep their order."""
+    if len(files) == 1:
+        return files[0]
+    return list(heapq.merge(*files, key=_timestamp))
+
+
+def compact(path: str = None) -> List[str]:
+    """Merges the segment files of each context into its data file, ordered by timestamp. Processes can keep
+    logging while segments are compacted. Returns the paths of the data files that segments were merged into."""
+    path = path or storage_path()
+    compacted = []
+    for storage_format in formats.values():
+        segments = defaultdict(list)
+        root, ext = os.path.splitext(storage_format.suffix)
+        for segment in sorted(glob(os.path.join(escape(path), f'*{root}.*{ext}'))):
+            segments[os.path.basename(segment).split('.')[0]].append(segment)
+        for context_hash, paths in sorted(segments.items()):
+            data_path = os.path.join(path, context_hash + storage_format.suffix)
+            with ExitStack() as stack:
+                # Writers wait until the files are replaced or removed and then write to new files
+                files = []
+                for file in [data_path] + paths:
+                    stack.enter_context(locked_append(file))
+                    files.append(storage_format.load(file)[0])
+                rows = merge_rows(files)
+                tmp = f"{data_path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp, 'wb') as f:
+                    write_all(f.fileno(), storage_format.pack([storage_format.encode(row) for row in rows]))
+                os.replace(tmp, data_path)
+                for segment in paths:
+                    os.remove(segment)
+            compacted.append(data_path)
+    return compacted
+
+
+def convert(to: str = 'binary', path: str = None) -> List[str]:
+    """Converts the data files in the storage to another format, after compacting them. Should not be used
+    while data is logged to the storage. Returns the paths of the converted files."""
+    target = get_format(to)
+    path = path or storage_path()
+    compact(path)
+    converted = []
+    for source_format in formats.values():
+        if source_format is target:
+            continue
+        for data_path in sorted(glob(os.path.join(path, '*' + source_format.suffix))):
+            target_path = data_path[:-len(source_format.suffix)] + target.suffix
+            if os.path.exists(target_path):
+                logger.warning(f"Skipping {data_path}: {target_path} exists already")
+                continue
+            rows, _ = source_format.load(data_path)
+            with open(target_path + '.tmp', 'wb') as f:
+                f.write(target.pack([target.encode(row) for row in rows]))
+            os.replace(target_path + '.tmp', target_path)
+            os.remove(data_path)
+            converted.append(target_path)
+    return converted
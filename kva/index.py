@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+from collections import defaultdict
+from glob import glob
+from typing import Any, Dict, Optional, Set
+
+from kva.conditions import Condition, _value_key
+from kva.utils import load_jsonl, locked_append, logger, storage_path, write_all
+
+
+class ContextIndex:
+    """Append-only index of all contexts in the storage, so that contexts can be found without
+    globbing and loading every `{hash}.context.json` file.
+
+    Each line of `contexts.index.jsonl` is `{"hash": ..., "context": {...}}`. In memory, the index
+    additionally maps each (key, value) of the contexts to the hashes of the contexts that have it."""
+    filename = 'contexts.index.jsonl'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, path):
+        self._path = path
+        self._offset = 0
+        self._inode = None
+        self.contexts: Dict[str, Dict[str, Any]] = {}
+        self._order = [] # Hashes in the order in which they were added, replaced when the index is read again
+        self._values = defaultdict(lambda: defaultdict(set)) # key -> value -> hashes
+        self._lacking = {} # key -> hashes of contexts without the key
+
+    @property
+    def path(self):
+        return os.path.join(storage_path(), self.filename)
+
+    def refresh(self):
+        """Read entries that have been appended to the index since the last read, e.g. by another process.
+        Builds the index from the context files if it doesn't exist yet."""
+        with self._lock:
+            path = self.path
+            if path != self._path:
+                self._reset(path)
+            if not os.path.exists(path):
+                self._build()
+            stat = os.stat(path)
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                self._reset(path)
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            entries, self._offset = load_jsonl(path, self._offset)
+            for entry in entries:
+                self._add(entry['hash'], entry['context'])
+
+    def _build(self):
+        lines = ''
+        for context_file in glob(os.path.join(os.path.dirname(self._path), '*.context.json')):
+            context_hash = os.path.basename(context_file).replace('.context.json', '')
+            with open(context_file, 'r') as f:
+                lines += json.dumps({'hash': context_hash, 'context': json.load(f)}) + '\n'
+        if lines:
+            logger.warning(f"Building the context index {self._path}")
+        self._append(lines)
+
+    def _append(self, lines: str):
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines.encode())
+        finally:
+            os.close(fd)
+
+    def _add(self, context_hash: str, context: Dict[str, Any]):
+        if context_hash in self.contexts:
+            return
+        self.contexts[context_hash] = context
+        self._order.append(context_hash)
+        for key, hashes in self._lacking.items():
+            if key not in context:
+                hashes.add(context_hash)
+        for key, value in context.items():
+            if key not in self._lacking:
+                self._lacking[key] = set(self.contexts) - {context_hash}
+            self._values[key][_value_key(value)].add(context_hash)
+
+    def add(self, context_hash: str, context: Dict[str, Any]):
+        """Add a context to the index, unless it is already indexed."""
+        self.refresh()
+        with self._lock:
+            if context_hash in self.contexts:
+                return
+            self._append(json.dumps({'hash': context_hash, 'context': context}) + '\n')
+        # Read our own entry like any other appended entry
+        self.refresh()
+
+    def reconcile(self):
+        """Add context files to the index that have been written without updating it."""
+        self.refresh()
+        for context_file in glob(os.path.join(storage_path(), '*.context.json')):
+            context_hash = os.path.basename(context_file).replace('.context.json', '')
+            if context_hash not in self.contexts:
+                with open(context_file, 'r') as f:
+                    self.add(context_hash, json.load(f))
+
+    def __contains__(self, context_hash: str):
+        return context_hash in self.contexts
+
+    def get(self, context_hash: str) -> Optional[Dict[str, Any]]:
+        if context_hash not in self.contexts:
+            self.refresh()
+        return self.contexts.get(context_hash)
+
+    def hashes(self):
+        self.refresh()
+        return list(self.contexts)
+
+    def since(self, position=None):
+        """Returns the hashes that have been added since `position`, and the position to pass to the next call.
+        Without a position, or if the index has been read again since, all hashes are returned."""
+        self.refresh()
+        with self._lock:
+            order = self._order
+            if position is None or position[0] is not order:
+                return list(order), (order, len(order))
+            return order[position[1]:], (order, len(order))
+
+    def candidates(self, conditions: Dict[str, Any]) -> Optional[Set[str]]:
+        """Returns the hashes of all contexts that are not rejected by `conditions`: for each key with a
+        condition that accepts a finite set of values, the context either has one of these values or
+        doesn't have the key, in which case the condition is checked per row. Other conditions are ignored.
+        Returns None if no condition restricts the contexts."""
+        self.refresh()
+        result = None
+        for key, condition in conditions.items():
+            if not isinstance(condition, Condition) or condition.values is None or key not in self._lacking:
+                continue
+            matches = set(self._lacking[key])
+            for value in condition.values:
+                matches |= self._values[key].get(_value_key(value), set())
+            result = matches if result is None else result & matches
+        return result
+
+
+_TYPE_NAMES = {type(None): 'null', bool: 'bool', int: 'int', float: 'float', str: 'str', dict: 'dict', list: 'list'}
+_VALUE_TYPES = {type(None), bool, int, str}
+
+
+class ContextSummary:
+    """Summary of the rows of a context: the types of the values of each column, and their distinct values as long as
+    these are at most `max_values` strings, ints, bools or None. Writers append the changes of the summary to
+    `{hash}.summary.jsonl`, so that runs can be listed and described without reading their rows."""
+    max_values = 20
+
+    def __init__(self):
+        self.types: Dict[str, Set[str]] = {}
+        self.values: Dict[str, Optional[Set[Any]]] = {} # column -> values, None if there are too many
+        self._known = set() # (column, type) of the values that have been added
+
+    @staticmethod
+    def path(context_hash: str) -> str:
+        return os.path.join(storage_path(), f'{context_hash}.summary.jsonl')
+
+    def add(self, rows) -> Dict[str, Any]:
+        """Adds rows to the summary. Returns the changes, as an entry of the summary file."""
+        new_types = defaultdict(set)
+        new_values = {}
+        known = self._known
+        values_of = self.values
+        for row in rows:
+            for key, value in row.items():
+                value_type = type(value)
+                if (key, value_type) not in known:
+                    known.add((key, value_type))
+                    name = _TYPE_NAMES.get(value_type, 'object')
+                    if key not in self.types:
+                        self.types[key] = set()
+                        values_of[key] = set()
+                    if name not in self.types[key]:
+                        self.types[key].add(name)
+                        new_types[key].add(name)
+                values = values_of[key]
+                if values is None:
+                    continue
+                if value_type not in _VALUE_TYPES:
+                    values_of[key] = new_values[key] = None
+                elif value in values:
+                    continue
+                elif len(values) >= self.max_values:
+                    values_of[key] = new_values[key] = None
+                else:
+                    values.add(value)
+                    new_values.setdefault(key, set()).add(value)
+        if not new_types and not new_values:
+            return {}
+        return {
+            'types': {key: sorted(types) for key, types in new_types.items()},
+            'values': {key: None if values is None else list(values) for key, values in new_values.items()},
+        }
+
+    def merge(self, entry: Dict[str, Any]):
+        for key, types in entry.get('types', {}).items():
+            self.types.setdefault(key, set()).update(types)
+            self.values.setdefault(key, set())
+        for key, values in entry.get('values', {}).items():
+            current = self.values.get(key, set())
+            if values is None or current is None or len(current | set(values)) > self.max_values:
+                self.values[key] = None
+            else:
+                self.values[key] = current | set(values)
+
+    def append(self, context_hash: str, entry: Dict[str, Any]):
+        if entry:
+            with locked_append(self.path(context_hash)) as fd:
+                write_all(fd, (json.dumps(entry, default=str) + '\n').encode())
+
+    def numeric(self, column: str) -> bool:
+        """Whether pandas infers a numeric dtype for the column, e.g. to plot it."""
+        types = self.types.get(column, set())
+        return bool(types - {'null'}) and (types <= {'int', 'float', 'null'} or types == {'bool'})
+
+
+# path -> (size of the summary file, summary)
+_summaries: Dict[str, Any] = {}
+
+
+def read_summary(context_hash: str) -> Optional[ContextSummary]:
+    """Returns the summary of a context from its summary file, which is read again when it grows. None if there is no summary."""
+    path = ContextSummary.path(context_hash)
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+    cached = _summaries.get(path)
+    if cached is not None and cached[0] == size:
+        return cached[1]
+    entries, _ = load_jsonl(path)
+    summary = ContextSummary()
+    for entry in entries:
+        summary.merge(entry)
+    _summaries[path] = (size, summary)
+    return summary
+
+
+context_index = ContextIndex()
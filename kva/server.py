@@ -1,17 +1,35 @@
 # kva/server.py
+import asyncio
 import json
 import os
-from typing import Any, Dict, List, Union
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from mimetypes import guess_type
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import pandas as pd
 import yaml
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
-from kva import File, kva, storage_path
+from kva import File, data_sources, get_context, get_time_of_hash, kva, storage_path
+from kva.formats import data_files
+from kva.index import ContextSummary, context_index, read_summary
+from kva.tail import last_lines, read_from
+from kva.downsample import downsample
+from kva.utils import read_table_segments
+from kva.watch import watcher
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 app = FastAPI()
 
@@ -42,16 +60,133 @@ class ViewConfig(BaseModel):
     panels: List[Dict[str, Any]]
 
 
-def load_config(config_path: str) -> ViewConfig:
-    with open(config_path, "r") as file:
-        config = yaml.safe_load(file)
-    return ViewConfig(**config)
+# config path -> (mtime, config)
+_configs = {}
+panel_pool = ThreadPoolExecutor(max_workers=max(1, int(os.environ.get("KVA_SERVER_WORKERS", 8))), thread_name_prefix="kva-panels")
+# Number of points per line of a lineplot panel that are sent to the frontend, unless the panel sets `points`
+plot_points = int(os.environ.get("KVA_PLOT_POINTS", 2000))
+_missing = object()
+# Encoding of text artifacts and log files for clients that accept it: gzip, zstd (if zstandard is installed, else gzip) or none
+compression = os.environ.get("KVA_SERVER_COMPRESSION", "gzip")
+_compressible = (".txt", ".log", ".out", ".err", ".csv", ".tsv", ".json", ".jsonl", ".yaml", ".yml", ".md", ".py", ".html", ".svg")
+# Maximal number of bytes of a log file that /artifacts/logfiles/{run_id}/{filename}/tail returns at once
+tail_limit = int(os.environ.get("KVA_TAIL_LIMIT", 1 << 20))
+# Artifacts in a directory named by the hash of their content
+_content_hash = re.compile(r"[0-9a-f]{32,128}")
+immutable = "public, max-age=31536000, immutable"
+
+
+class StateCache:
+    """LRU cache of values that remain valid while the data they were computed from has the same DB.state()."""
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, state):
+        with self._lock:
+            cached = self._items.get(key)
+            if cached is None or cached[0] != state:
+                return _missing
+            self._items.move_to_end(key)
+            return cached[1]
+
+    def put(self, key, state, value):
+        with self._lock:
+            self._items[key] = (state, value)
+            self._items.move_to_end(key)
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+# (config path, run path, panel, points, x range) -> json of the panel
+_panel_cache = StateCache(int(os.environ.get("KVA_SERVER_CACHE_SIZE", 1024)))
+# (config path, run path, panel) -> data of a lineplot at full resolution, which is downsampled per request
+_plot_cache = StateCache(64)
+# run_id -> {filename: path} of the log files of a run
+_logfile_cache = StateCache(256)
 
 
-def get_run_data(keys: Dict[str, Any], columns: List[str], index: str = None):
-    # kva.reload()
-    db = kva.get(**keys)
-    return db.latest(columns, index=index)
+def load_config(config_path: str) -> ViewConfig:
+    """Parses the config, which is reloaded when the file changes."""
+    mtime = os.stat(config_path).st_mtime_ns
+    cached = _configs.get(config_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(config_path, "r") as file:
+        config = ViewConfig(**yaml.safe_load(file))
+    _configs[config_path] = (mtime, config)
+    return config
+
+
+def panel_index(panel: Dict[str, Any]):
+    index = panel.get("index")
+    if slider := panel.get("slider"):
+        if index is None:
+            index = slider
+        elif isinstance(index, list):
+            index = [slider] + index
+        else:
+            index = [slider, index]
+    return index
+
+
+def is_plot(panel: Dict[str, Any]) -> bool:
+    return panel["type"] == "lineplot" and isinstance(panel.get("index"), str) and not panel.get("slider")
+
+
+def _bound(name: str, value: Optional[str], numeric: bool):
+    """Parses a bound of the x values, which are compared as numbers if the index is numeric and as strings otherwise."""
+    if value is None or not numeric:
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be a number, not {value!r}")
+
+
+def plot_data(df: pd.DataFrame, panel: Dict[str, Any], points: Optional[int] = None,
+              x_min: Optional[str] = None, x_max: Optional[str] = None):
+    """Restricts the data of a lineplot to a range of x values, and downsamples it to about `points` points per line.
+    Returns the data and the number of rows in the range."""
+    numeric = pd.api.types.is_numeric_dtype(df.index)
+    x_min, x_max = _bound("x_min", x_min, numeric), _bound("x_max", x_max, numeric)
+    if x_min is not None:
+        df = df[df.index >= x_min]
+    if x_max is not None:
+        df = df[df.index <= x_max]
+    points = panel.get("points", plot_points) if points is None else points
+    return downsample(df, points, panel.get("downsample", "minmax")), len(df)
+
+
+def render_panel(db, path: str, panel: Dict[str, Any], points: Optional[int] = None,
+                 x_min: Optional[str] = None, x_max: Optional[str] = None) -> Optional[str]:
+    """Returns the json of a panel of a run, or None if there is no data for it.
+    The result is cached until rows are added to the run."""
+    key = (config_path, path, json.dumps(panel, sort_keys=True))
+    state = db.state()
+    content = _panel_cache.get(key + (points, x_min, x_max), state)
+    if content is not _missing:
+        return content
+    data = _plot_cache.get(key, state) if is_plot(panel) else _missing
+    if data is _missing:
+        data = db.latest(panel["columns"], index=panel_index(panel))
+        if is_plot(panel):
+            _plot_cache.put(key, state, data)
+    content = None
+    if len(data) > 0:
+        rows = len(data)
+        if is_plot(panel) and isinstance(data, pd.DataFrame):
+            data, rows = plot_data(data, panel, points, x_min, x_max)
+        content = json.dumps({
+            "data": jsonable_encoder(data),
+            "type": panel["type"],
+            "index": panel.get("index"),
+            "slider": panel.get("slider"),
+            "rows": rows,
+        }, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+    _panel_cache.put(key + (points, x_min, x_max), state, content)
+    return content
 
 
 def replace_nan_with_none(data: Any) -> Any:
@@ -75,78 +210,264 @@ def jsonable_encoder(data: Any) -> Any:
 
 
 @app.get("/data/{path:path}")
-async def view_run(path: str):
-    global config_path
+async def view_run(path: str, panel: Optional[str] = None, points: Optional[int] = None,
+                   x_min: Optional[str] = None, x_max: Optional[str] = None):
+    """Data of the panels of a run, or of one `panel`. Lineplots are restricted to x values between `x_min` and
+    `x_max` and downsampled to about `points` points per line, points=0 returns all points."""
     config = load_config(config_path)
     keys = dict(zip(config.index, path.split("/")))
-    run_data = {}
-
-    for panel in config.panels:
-        columns = panel["columns"]
-        index = panel.get("index")
-        if slider := panel.get("slider"):
-            if index is None:
-                index = slider
-            elif isinstance(index, list):
-                index = [slider] + index
-            else:
-                index = [slider, index]
-        data = get_run_data(keys, columns, index)
-        if len(data) == 0:
-            continue
-        run_data[panel["name"]] = {
-            "data": jsonable_encoder(data),
-            "type": panel["type"],
-            "index": panel.get("index"),
-            "slider": panel.get("slider"),
-        }
-    print(json.dumps(run_data, indent=2))
-    return JSONResponse(content=run_data)
+    db = kva.get(**keys)
+    # Panels are computed concurrently and streamed in the order of the config. All panels are computed before the
+    # response starts, so that errors are not sent with a successful status
+    names = [p["name"] for p in config.panels if panel is None or p["name"] == panel]
+    contents = await asyncio.gather(*(asyncio.wrap_future(panel_pool.submit(render_panel, db, path, p, points, x_min, x_max))
+                                      for p in config.panels if panel is None or p["name"] == panel))
+
+    def stream():
+        separator = "{"
+        for name, content in zip(names, contents):
+            if content is None:
+                continue
+            yield f"{separator}{json.dumps(name, ensure_ascii=False)}:{content}"
+            separator = ","
+        yield "{}" if separator == "{" else "}"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
+@app.get("/stream/{path:path}")
+async def stream_run(path: str, request: Request, points: Optional[int] = None):
+    """Server-sent events with the panels of a run: all panels when connecting, and the panels that changed whenever
+    rows are added to the run. Changes are detected by watching the data files, and panels are computed once per change
+    for all clients via the panel cache."""
+    config = load_config(config_path)
+    keys = dict(zip(config.index, path.split("/")))
+    db = kva.get(**keys)
+    run_hashes = {context_hash for context_hash, _ in db.data_sources}
+    known = set(run_hashes) # Hashes of which we know whether they belong to the run
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    reported = [] # Hashes of the changed contexts, None if they are not known
+
+    def report(hashes):
+        reported.append(hashes)
+        changed.set()
+
+    def notify(hashes):
+        # Called on the thread of the watcher, the changes are checked on the event loop
+        loop.call_soon_threadsafe(report, hashes)
+
+    def run_changed() -> bool:
+        hashes = set()
+        for changes in reported:
+            hashes = None if hashes is None or changes is None else hashes | changes
+        reported.clear()
+        if hashes is not None and not hashes <= known:
+            # Contexts that have been created since connecting, e.g. with `kva.context(epoch=...)` in the run
+            run_hashes.update(context_hash for context_hash, _ in db.data_sources)
+            known.update(hashes)
+        return hashes is None or bool(hashes & run_hashes)
+
+    unsubscribe = watcher(storage_path()).subscribe(notify)
+
+    async def events():
+        sent = {}
+        render = True
+        try:
+            while not await request.is_disconnected():
+                if render:
+                    contents = await asyncio.gather(*(asyncio.wrap_future(panel_pool.submit(render_panel, db, path, panel, points))
+                                                      for panel in config.panels))
+                    update = {panel["name"]: content for panel, content in zip(config.panels, contents)
+                              if content is not None and sent.get(panel["name"]) != content}
+                    if update:
+                        sent.update(update)
+                        yield "data: {" + ",".join(f"{json.dumps(name, ensure_ascii=False)}:{content}" for name, content in update.items()) + "}\n\n"
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    render = False
+                    yield ": keep-alive\n\n"
+                    continue
+                changed.clear()
+                render = run_changed()
+        finally:
+            unsubscribe()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 
 @app.get("/reload")
 async def reload_data():
-    global kva_instance
-    kva_instance.reload()
+    kva.reload()
+    return JSONResponse(content={"status": "ok"})
+
+def context_summary(context_hash: str) -> Optional[ContextSummary]:
+    """The summary of the rows of a context, None if it has no rows."""
+    summary = read_summary(context_hash)
+    if summary is None and data_files(context_hash):
+        summary = data_sources[context_hash].summary()
+    return summary
+
+
+def run_paths(index: List[str]) -> Dict[str, tuple]:
+    """Returns the path of each run, i.e. each combination of the values of the `index` columns in rows, and the time
+    at which it started followed by the position of its first context in the index, to order runs that started together. Runs are found via the contexts and their summaries, rows are only read for contexts that
+    vary more than one index column, or too many values of it, between rows."""
+    runs = {}
+    for position, context_hash in enumerate(context_index.hashes()):
+        context = get_context(context_hash)
+        summary = context_summary(context_hash)
+        if summary is None:
+            continue
+        fields = [key for key in index if key not in context]
+        if any(key not in summary.types for key in fields):
+            continue
+        if not fields:
+            combinations = [tuple(context[key] for key in index)]
+        elif len(fields) == 1 and summary.values[fields[0]] is not None:
+            combinations = [tuple(context.get(key, value) for key in index) for value in summary.values[fields[0]]]
+        else:
+            combinations = {tuple(row.get(key, context.get(key)) for key in index) for row in data_sources[context_hash].data}
+        started = (context.get(".run_started_at", ""), position)
+        for combination in combinations:
+            path = "/".join(str(value) for value in combination)
+            runs[path] = min(runs.get(path, started), started)
+    return runs
+
 
 @app.get("/runs")
-async def list_runs():
+async def list_runs(offset: int = 0, limit: Optional[int] = None, order: str = "asc"):
+    """Paths of the runs sorted by the time at which they started, `order=desc` lists the latest runs first."""
     config = load_config(config_path)
-    df = pd.DataFrame(kva.data)
-    if not all(col in df.columns for col in config.index):
-        raise HTTPException(status_code=400, detail="Invalid index columns in config")
+    runs = await asyncio.get_running_loop().run_in_executor(panel_pool, run_paths, config.index)
+    paths = sorted(runs, key=runs.get, reverse=order == "desc")
+    end = None if limit is None else offset + limit
+    return JSONResponse(content={"runs": paths[offset:end], "total": len(paths)})
 
-    runs = df[config.index].drop_duplicates().to_dict(orient="records")
-    run_paths = ["/".join(str(run[key]) for key in config.index) for run in runs]
-    print(run_paths)
-    return JSONResponse(content={"runs": run_paths})
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    tags = request.headers.get("if-none-match")
+    return tags is not None and (tags.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in tags.split(",")))
+
+
+def _encoding(request: Request, path: str, media_type: Optional[str]) -> Optional[str]:
+    """The encoding in which a file is sent: None for binary files, range requests and clients that don't accept one."""
+    if compression not in ("gzip", "zstd") or "range" in request.headers:
+        return None
+    if not path.endswith(_compressible) and not (media_type or "").startswith("text/"):
+        return None
+    accepted = {encoding.split(";")[0].strip() for encoding in request.headers.get("accept-encoding", "").split(",")}
+    if compression == "zstd" and zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    return "gzip" if "gzip" in accepted else None
+
+
+def _compressed(chunks, encoding: str):
+    compressor = zstandard.ZstdCompressor().compressobj() if encoding == "zstd" else zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _file_chunks(path: str, size: int = 1 << 20):
+    with open(path, "rb") as f:
+        while chunk := f.read(size):
+            yield chunk
+
+
+def file_response(request: Request, path: str, etag: str, cache_control: str,
+                  media_type: Optional[str] = None, content: Optional[Callable[[], bytes]] = None) -> Response:
+    """Serves a file, or the result of `content` that is generated from it, with `etag`: answers conditional requests
+    with 304 without reading the file, ranges with 206, and compresses text when the client accepts it."""
+    encoding = _encoding(request, path, media_type)
+    if encoding is not None:
+        # Each encoding is a different representation, with its own strong etag
+        etag = f'{etag[:-1]}-{encoding}"'
+    headers = {"etag": etag, "cache-control": cache_control, "vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding is not None:
+        headers["content-encoding"] = encoding
+        chunks = [content()] if content is not None else _file_chunks(path)
+        return StreamingResponse(_compressed(chunks, encoding), media_type=media_type or guess_type(path)[0], headers=headers)
+    if content is not None:
+        return Response(content(), media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def logfile_source(run_id: str, filename: str) -> Optional[str]:
+    """The path of a log file, from the latest values of its run. The log files of a run are cached until rows are
+    added to it, also to answer requests for files that don't exist."""
+    db = kva.get(run_id=run_id)
+    state = db.state()
+    logfiles = _logfile_cache.get(run_id, state)
+    if logfiles is _missing:
+        logfiles = {}
+        for value in db.latest("*").values():
+            if isinstance(value, dict) and isinstance(value.get("filename"), str) and isinstance(value.get("src"), str):
+                # Log files take precedence over other files with the same name, which are also found once a log file is stored
+                if value["filename"] not in logfiles or str(value.get("path")).startswith("artifacts/logfiles/"):
+                    logfiles[value["filename"]] = value["src"]
+        _logfile_cache.put(run_id, state, logfiles)
+    return logfiles.get(filename)
 
 
 @app.get("/artifacts/logfiles/{run_id}/{filename}")
-async def serve_log_file(run_id: str, filename: str):
-    values = kva.get(run_id=run_id).latest("*")
-    for k, v in values.items():
-        try:
-            assert v['filename'] == filename
-            log_file_path = v['src']
-            break
-        except:
-            pass
-    if not os.path.exists(log_file_path):
-        print(f"Log file not found: {log_file_path}")
+async def serve_log_file(run_id: str, filename: str, request: Request):
+    log_file_path = None if ".." in (run_id, filename) else logfile_source(run_id, filename)
+    if log_file_path is None or not os.path.isfile(log_file_path):
+        print(f"Log file not found: {run_id}/{filename}")
         raise HTTPException(status_code=404, detail="Log file not found")
-    return FileResponse(log_file_path)
+    # Log files grow while they are written, so clients revalidate them
+    stat = os.stat(log_file_path)
+    etag = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    return file_response(request, log_file_path, etag, "no-cache", media_type="text/plain; charset=utf-8")
+
+
+@app.get("/artifacts/logfiles/{run_id}/{filename}/tail")
+def tail_log_file(run_id: str, filename: str, offset: Optional[int] = None, lines: int = 100, limit: int = tail_limit):
+    """Returns the text of a log file from `offset` up to `limit` bytes, or its last `lines` lines if no offset is given,
+    with the offset from which to continue (`next`). Clients tail a log by requesting it again from `next`."""
+    log_file_path = None if ".." in (run_id, filename) else logfile_source(run_id, filename)
+    if log_file_path is None or not os.path.isfile(log_file_path):
+        raise HTTPException(status_code=404, detail="Log file not found")
+    limit = min(max(limit, 4), tail_limit)
+    if offset is None:
+        data, start, size = last_lines(log_file_path, max(lines, 0))
+        if len(data) > limit:
+            # Only whole lines of the last `limit` bytes
+            data = data[-limit:]
+            data = data[data.find(b"\n") + 1:] if b"\n" in data[:-1] else data
+            start = size - len(data)
+        end = start + len(data)
+    else:
+        data, end, size = read_from(log_file_path, max(offset, 0), limit)
+        start = end - len(data)
+    return {"text": data.decode(errors="replace"), "offset": start, "next": end, "size": size}
 
 
 @app.get("/artifacts/{file_path:path}")
-async def serve_file(file_path: str):
+async def serve_file(file_path: str, request: Request, format: Optional[str] = None):
     file_location = os.path.join(storage_path(), "artifacts", file_path)
     file_location = os.path.expanduser(file_location)
-    if not os.path.exists(file_location):
+    if not os.path.isfile(file_location):
         print(f"File not found: {file_location}")
         raise HTTPException(status_code=404, detail="File not found")
-    if file_path.endswith(".csv"):
-        return FileResponse(file_location, media_type="text/csv")
-    return FileResponse(file_location)
+    content_hash = file_path.split("/")[0]
+    if _content_hash.fullmatch(content_hash):
+        # Files in artifacts/{hash}/ never change
+        etag, cache_control = f'"{content_hash}"', immutable
+    else:
+        stat = os.stat(file_location)
+        etag, cache_control = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"', "no-cache"
+    if (file_path.endswith(".parquet") or ".segment." in file_path) and format == "csv":
+        # The frontend renders tables from CSV, including the previous segments of appended tables
+        return file_response(request, file_location, f'{etag[:-1]}-csv"', cache_control, "text/csv",
+                             lambda: read_table_segments(file_location).to_csv(index=False).encode())
+    media_type = "text/csv" if file_path.endswith(".csv") else None
+    return file_response(request, file_location, etag, cache_control, media_type)
 
 
 @app.get("/{full_path:path}")
@@ -166,17 +487,25 @@ async def serve_frontend(full_path: str):
 
 
 def make_config():
+    """Writes a config with a summary panel and a lineplot for each numeric column, based on the summaries of the contexts."""
     config = {
         "index": ["run_id"],
         "panels": [{"name": "Summary", "columns": "*", "type": "data"}],
     }
-    df = pd.DataFrame(kva.data)
-    for col in df.columns:
+    summary = ContextSummary()
+    for context_hash in sorted(context_index.hashes(), key=get_time_of_hash):
+        rows = context_summary(context_hash)
+        if rows is None:
+            continue
+        # Rows are merged with their context
+        summary.add([get_context(context_hash)])
+        summary.merge({"types": {key: list(types) for key, types in rows.types.items()}})
+    for col in summary.types:
         if col in ["timestamp", "run_id"]:
             continue
         # For all scalars, add a line plot
-        if pd.api.types.is_numeric_dtype(df[col]):
-            index = "step" if "step" in df.columns else "timestamp"
+        if summary.numeric(col):
+            index = "step" if "step" in summary.types else "timestamp"
             if col == "step":
                 index = "timestamp"
             config["panels"].append(
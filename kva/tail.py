@@ -0,0 +1,56 @@
+import os
+from typing import Tuple
+
+# Size of the blocks in which files are read backwards
+block_size = 1 << 16
+
+
+def read_from(path: str, offset: int, limit: int) -> Tuple[bytes, int, int]:
+    """Reads at most `limit` bytes of a file from `offset`, ending with the last complete line unless a single line is
+    longer than `limit`. Returns (data, offset after the data, size of the file). Reads from the start if the file is
+    smaller than `offset`, e.g. because it was truncated."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset > size:
+            offset = 0
+        f.seek(offset)
+        data = f.read(limit)
+    if offset + len(data) < size and b'\n' in data:
+        data = data[:data.rindex(b'\n') + 1]
+    elif not data.endswith(b'\n'):
+        data = data[:len(data) - _incomplete(data)]
+    return data, offset + len(data), size
+
+
+def _incomplete(data: bytes) -> int:
+    """Number of bytes at the end of `data` that start a UTF-8 encoded character without completing it."""
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0xC0 != 0x80:
+            length = 1 if byte < 0xC0 else 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            return i if i < length else 0
+    return 0
+
+
+def last_lines(path: str, lines: int) -> Tuple[bytes, int, int]:
+    """Reads the last `lines` lines of a file with backward block reads, so that only the end of a large file is read.
+    Returns (data, offset of the data, size of the file)."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = size
+        blocks = []
+        newlines = 0
+        while start > 0 and newlines < lines + 1:
+            read = min(block_size, start)
+            start -= read
+            f.seek(start)
+            blocks.append(f.read(read))
+            newlines += blocks[-1].count(b'\n')
+    data = b''.join(reversed(blocks))
+    # The newline that ends the last line doesn't start another line
+    cut = len(data) - 1 if data.endswith(b'\n') else len(data)
+    for _ in range(lines):
+        cut = data.rfind(b'\n', 0, cut)
+        if cut < 0:
+            return data, start, size
+    return data[cut + 1:], start + cut + 1, size
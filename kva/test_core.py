@@ -1,20 +1,34 @@
+import gc
+import glob
+import hashlib
+import json
 import os
 import pickle
 import shutil
+import subprocess
+import sys
+import threading
+import time
 import uuid
 from dataclasses import dataclass
 from datetime import datetime
+from enum import Enum
 
 import hydra
 import numpy as np
 import pandas as pd
 import pytest
 import torch
+import yaml
 from hydra import compose, initialize
 from hydra.core.config_store import ConfigStore
 from omegaconf import OmegaConf
 
-from kva import DB, File, LogFile, Folder, kva, set_storage, storage_path
+from kva import DB, File, LogFile, Folder, Source, Table, kva, set_storage, storage_path, Eq, In, Range, Exists
+import kva as kva_module
+from kva.artifacts import artifact_store, store_file
+from kva.downsample import downsample, lttb, minmax
+from kva.formats import BinaryFormat, JsonlFormat, compact, convert, segment_paths
 
 
 # Fixture to create and clean up a test environment
@@ -129,6 +143,10 @@ def test_pickle_serialization(setup_env):
     kva.log(custom_object=obj)
     result = kva.get(run_id="pickle-run").latest("custom_object")
     assert isinstance(result, File), "Pickle object not serialized as a file"
+    # The pickled object is stored once, at the path that is logged
+    pickles = glob.glob(os.path.join(storage_path(), "artifacts", "**", "CustomClass_*.pkl"), recursive=True)
+    assert len(pickles) == 1
+    assert result["path"] == os.path.relpath(pickles[0], storage_path())
 
 
 def test_log_local_class_object(setup_env):
@@ -241,6 +259,28 @@ def test_as_df_method(setup_env):
     pd.testing.assert_frame_equal(retrieved_df, df)
 
 
+def test_table_dedup_and_projection(setup_env):
+    kva.init(run_id="table-run")
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"], "c": [0.5, 1.5]})
+    kva.log(step=1, table=df)
+    table = kva.get(run_id="table-run").latest("table")
+    path = os.path.join(storage_path(), table["path"])
+    mtime = os.stat(path).st_mtime_ns
+    kva.log(step=2, table=df.copy())
+    assert kva.get(run_id="table-run").latest("table")["path"] == table["path"]
+    assert os.stat(path).st_mtime_ns == mtime
+    pd.testing.assert_frame_equal(table.as_df(columns=["c", "a"]), df[["c", "a"]])
+    hits = kva_module.utils.read_table.cache_info().hits
+    table.as_df(columns=["c", "a"])["a"] = 0
+    assert kva_module.utils.read_table.cache_info().hits == hits + 1
+    pd.testing.assert_frame_equal(table.as_df(columns=["c", "a"]), df[["c", "a"]])
+    # Tables with the same values but different columns are stored separately
+    kva.log(step=3, renamed=pd.DataFrame({"u": [1, 2]}), original=pd.DataFrame({"v": [1, 2]}))
+    latest = kva.get(run_id="table-run").latest(["renamed", "original"])
+    assert list(latest["renamed"].as_df().columns) == ["u"]
+    assert list(latest["original"].as_df().columns) == ["v"]
+
+
 def test_logfile(setup_env):
     kva.init(run_id="test-logfile-run")
     log_src = __file__
@@ -251,5 +291,659 @@ def test_logfile(setup_env):
     assert logfile["path"] == "artifacts/logfiles/test-logfile-run/test_core.py"
 
 
+def test_flush(setup_env):
+    kva.init(run_id="flush-run")
+    kva.log(step=1, loss=0.5)
+    kva_module.flush()
+    with open(kva.logged_data.data_path) as f:
+        assert '"loss": 0.5' in f.read()
+
+
+def test_background_writer_backpressure(setup_env):
+    kva.init(run_id="backpressure-run")
+    source = kva.logged_data
+    source.flush_rows = 3
+    source.max_buffer_rows = 5
+    for step in range(100):
+        kva.log(step=step)
+        assert len(source.buffer) <= 5
+    kva.flush()
+    with open(source.data_path) as f:
+        assert len(f.readlines()) == 100
+    assert kva.get(run_id="backpressure-run").latest("step") == 99
+
+
+def test_idle_writers_exit(setup_env, monkeypatch):
+    monkeypatch.setattr(Source, "flush_interval", 0.05)
+    kva.init(run_id="idle-writers-run")
+    threads = threading.active_count()
+    for sample in range(20):
+        with kva.context(sample=sample):
+            kva.log(loss=0.5)
+    time.sleep(0.5)
+    assert threading.active_count() <= threads
+    # A context that is logged to again starts a new writer
+    with kva.context(sample=0):
+        kva.log(loss=0.25)
+    kva.flush()
+    assert [row["loss"] for row in kva.get(run_id="idle-writers-run", sample=0).data] == [0.5, 0.25]
+
+
+def test_tail_reading(setup_env):
+    kva.init(run_id="tail-run")
+    kva.log(step=1)
+    kva.flush()
+    source = kva.logged_data
+    # Another process appends rows, the last one is not complete yet
+    with open(source.data_path, "a") as f:
+        f.write('{"step": 2}\n{"step": 3}\n{"st')
+    assert [row["step"] for row in source.data] == [1, 2, 3]
+    with open(source.data_path, "a") as f:
+        f.write('ep": 4}\n')
+    kva.log(step=5)
+    assert [row["step"] for row in source.data] == [1, 2, 3, 4, 5]
+    kva.flush()
+    assert [row["step"] for row in source.data] == [1, 2, 3, 4, 5]
+    assert kva.get(run_id="tail-run").latest("step") == 5
+
+
+def test_columnar_frame(setup_env):
+    kva.init(run_id="columnar-run")
+    kva.log(step=1, loss=1, text="a")
+    kva.log(step=2, config={"lr": 0.1})
+    kva.log(step=3, loss=0.5, text=None, flag=True)
+    db = kva.get(run_id="columnar-run")
+    expected = pd.DataFrame(db.data)
+    assert db._columns() == list(expected.columns)
+    pd.testing.assert_frame_equal(db._frame(list(expected.columns)), expected)
+    # Rows logged later are added to the existing columns
+    kva.log(step=4, loss=0.25)
+    assert len(kva.logged_data.columns) == 4
+    assert kva.get(run_id="columnar-run").latest("loss", index="step")["loss"].tolist() == [1, 0.5, 0.25]
+
+
+def test_context_index(setup_env):
+    from kva.index import ContextIndex, context_index
+
+    kva.init(run_id="index-run-1")
+    kva.log(step=1)
+    hash_1 = kva.context_hash
+    kva.init(run_id="index-run-2")
+    kva.log(step=1)
+    hash_2 = kva.context_hash
+    kva.flush()
+    # A fresh index reads the entries written by Source.write
+    index = ContextIndex()
+    assert index.get(hash_1)["run_id"] == "index-run-1"
+    candidates = index.candidates({"run_id": Eq("index-run-1")})
+    assert hash_1 in candidates and hash_2 not in candidates
+    # Keys that are not part of the context are checked per row, so they don't exclude contexts
+    assert hash_1 in index.candidates({"run_id": Eq("index-run-1"), "step": Eq(1)})
+    assert index.candidates({"step": Eq(1)}) is None
+    assert kva.get(run_id="index-run-1").latest("run_id") == "index-run-1"
+    # A missing index is rebuilt from the context files
+    os.remove(context_index.path)
+    assert hash_1 in ContextIndex().hashes()
+
+
+def test_filter_finds_contexts_of_other_processes(setup_env):
+    assert kva.get(run_id="other-process-run").latest("loss") is None
+    script = (
+        "import sys\n"
+        "from kva import kva, set_storage\n"
+        "set_storage(sys.argv[1])\n"
+        "kva.init(run_id='other-process-run')\n"
+        "kva.log(loss=0.5)\n"
+        "kva.flush()\n"
+    )
+    subprocess.run([sys.executable, '-c', script, storage_path()], check=True)
+    assert kva.get(run_id="other-process-run").latest("loss") == 0.5
+
+
+def test_filter_conditions(setup_env):
+    kva.init(run_id="conditions-run")
+    for step in range(5):
+        kva.log(step=step, loss=1 / (step + 1), phase="train" if step % 2 else "eval")
+    run = kva.get(run_id="conditions-run")
+    assert run.data_sources is kva.get(run_id="conditions-run").data_sources
+    steps = run.filter({"step": Range(1, 3)}).latest("loss", index="step")
+    assert steps.index.tolist() == [1, 2]
+    assert run.filter({"phase": In(["eval"])}).latest("step") == 4
+    assert run.filter({"step": Eq(1) | Eq(3)}).latest("loss", index="step").index.tolist() == [1, 3]
+    assert run.filter({"step": Range(low=3) & Exists()}).latest("step", index="step").index.tolist() == [3, 4]
+    assert len(run.filter({"step": lambda step: step > 2}).data) == 2
+    row = run.filter({"step": Eq(4)}).data[0]
+    assert row["run_id"] == "conditions-run" and row["step"] == 4
+    assert json.loads(json.dumps(row)) == row
+    # Rows of other runs are excluded by the conditions on the context
+    assert kva.get(run_id="conditions-run", step=4).latest("run_id") == "conditions-run"
+    assert len(kva.get(run_id="missing-run", step=4).data) == 0
+
+
+def test_data_cache(setup_env):
+    kva.init(run_id="cache-run")
+    kva.log(step=1)
+    run = kva.get(run_id="cache-run")
+    data = run.data
+    assert run.data is data
+    generation = kva.logged_data.generation
+    kva.log(step=2)
+    assert kva.logged_data.generation == generation + 1
+    assert [row["step"] for row in run.data] == [1, 2]
+    assert [row["step"] for row in run.filter({"step": Range(2)}).data] == [2]
+    kva.log(step=3)
+    assert [row["step"] for row in run.filter({"step": Range(2)}).data] == [2, 3]
+
+
+def test_cached_views_are_not_shared(setup_env):
+    kva.init(run_id="view-x")
+    kva.log(step=1)
+    view = kva.get(run_id="view-x")
+    with view.context(epoch=3):
+        assert kva.get(run_id="view-x").logged_data.context.get("epoch") is None
+    view.init(run_id="view-y")
+    assert kva.get(run_id="view-x").latest("run_id") == "view-x"
+    # The cache of views is bounded, views that are no longer used are dropped
+    views = len(DB._views)
+    for sample in range(DB._view_cache_size + 10):
+        kva.get(run_id="view-x", sample=sample)
+    assert len(DB._view_cache) == DB._view_cache_size
+    gc.collect()
+    assert len(DB._views) <= views + DB._view_cache_size
+
+
+def test_latest_deep_merge_across_sources(setup_env):
+    kva.init(run_id="merge-run", phase="a")
+    kva.log(config={"lr": {"start": 1, "end": 0}, "seed": 1})
+    kva.log(config={"lr": 0.5})
+    kva.log(config={"lr": {"end": 2}})
+    kva.init(run_id="merge-run", phase="b")
+    kva.log(config={"seed": 2})
+    run = DB().get(run_id="merge-run")
+    assert run.latest("config") == {"lr": {"end": 2}, "seed": 2}
+    assert run.latest("config", deep_merge=False) == {"seed": 2}
+    assert run.latest("phase") == "b"
+    kva.log(config={"lr": 3})
+    assert run.latest("config") == {"lr": 3, "seed": 2}
+
+
+def test_latest_with_index_deep_merge(setup_env):
+    kva.init(run_id="index-merge-run")
+    kva.log(step=1, config={"a": {"x": 1}})
+    kva.log(step=1, config={"a": {"y": 2}}, loss=1.0)
+    kva.log(step=2, config={"b": 3})
+    kva.log(step=2, config=None)
+    run = kva.get(run_id="index-merge-run")
+    result = run.latest(["config", "loss"], index="step", deep_merge=True)
+    assert result.loc[1, "config"] == {"a": {"x": 1, "y": 2}}
+    assert result.loc[2, "config"] == {"b": 3}
+    assert result.loc[1, "loss"] == 1.0 and np.isnan(result.loc[2, "loss"])
+    # The logged values are not modified by merging
+    assert run.data[0]["config"] == {"a": {"x": 1}}
+    result = run.latest(["config", "loss"], index="step", deep_merge=False)
+    assert result.loc[1, "config"] == {"a": {"y": 2}}
+
+
+def test_binary_format(setup_env, monkeypatch):
+    monkeypatch.setattr(Source, "storage_format", "binary")
+    kva.init(run_id="binary-run")
+    rows = [{"step": 1, "loss": 0.5, "done": False}, {"text": "héllo", "config": {"a": [1, None]}, "big": 2**64}]
+    for row in rows:
+        kva.log(row)
+    kva.flush()
+    source = kva.logged_data
+    assert source.data_path.endswith(".data.kvb")
+    stored = BinaryFormat().load(source.data_path)[0]
+    assert [{key: row[key] for key in logged} for row, logged in zip(stored, rows)] == rows
+    assert stored == JsonlFormat().decode([JsonlFormat().encode(row) for row in source.data])
+    # Another process appends a block, which is read once it is complete
+    block = BinaryFormat().pack([BinaryFormat().encode({"step": 2})])
+    with open(source.data_path, "ab") as f:
+        f.write(block[:7])
+    assert len(source.data) == 2
+    with open(source.data_path, "ab") as f:
+        f.write(block[7:])
+    assert kva.get(run_id="binary-run").latest("step") == 2
+
+
+def test_convert(setup_env):
+    kva.init(run_id="convert-run")
+    kva.log(step=1, loss=0.5, config={"lr": 1})
+    kva.flush()
+    jsonl_path = kva.logged_data.data_path
+    rows = JsonlFormat().load(jsonl_path)[0]
+    assert jsonl_path in [path.replace(".data.kvb", ".data.jsonl") for path in convert("binary")]
+    assert not os.path.exists(jsonl_path)
+    assert BinaryFormat().load(jsonl_path.replace(".data.jsonl", ".data.kvb"))[0] == rows
+    convert("jsonl")
+    assert JsonlFormat().load(jsonl_path)[0] == rows
+
+
+def test_log_converts_values_to_json(setup_env):
+    kva.init(run_id="json-run")
+    row = kva.log(
+        loss=np.float32(0.5), steps=np.arange(3), t=torch.tensor([1.0, 2.0]), pair=(1, (2, 3)),
+        started=datetime(2024, 1, 2), nested={1: {"x": np.int64(4)}},
+    )
+    assert row == {**row, "loss": 0.5, "steps": [0, 1, 2], "t": [1.0, 2.0], "pair": [1, [2, 3]],
+                   "started": "2024-01-02T00:00:00", "nested": {"1": {"x": 4}}}
+    assert type(row["nested"]["1"]["x"]) is int
+    kva.flush()
+    assert JsonlFormat().load(kva.logged_data.data_path)[0][-1] == row
+
+
+def test_log_str_subclasses_like_json(setup_env):
+    class Split(str, Enum):
+        TRAIN = "train"
+
+    kva.init(run_id="str-subclass-run")
+    row = kva.log(split=Split.TRAIN, splits={Split.TRAIN: [Split.TRAIN]})
+    assert row["split"] == "train" and type(row["split"]) is str
+    assert row["splits"] == {"train": ["train"]}
+    assert row["splits"] == json.loads(json.dumps({Split.TRAIN: [Split.TRAIN]}))
+
+
+def test_log_many_and_arrays(setup_env):
+    kva.init(run_id="batch-run")
+    kva.log(step=1, loss=1.0)
+    rows = kva.log_many([{"loss": 0.9}, {"step": 2, "loss": 0.8}])
+    assert [row["step"] for row in rows] == [1, 2]
+    assert rows[0]["timestamp"] == rows[1]["timestamp"]
+    kva.log_arrays(step=np.array([3, 4, 5]), loss=torch.tensor([0.5, 0.25, 0.125]), split="eval")
+    kva.log_arrays(loss=[0.1, 0.05])
+    run = kva.get(run_id="batch-run")
+    assert [row["step"] for row in run.data] == [1, 1, 2, 3, 4, 5, 5, 5]
+    assert [row["loss"] for row in run.data][-5:] == [0.5, 0.25, 0.125, 0.1, 0.05]
+    assert run.data[3]["split"] == "eval"
+    with pytest.raises(ValueError):
+        kva.log_arrays(step=[1, 2], loss=[1.0])
+    kva.flush()
+    assert len(JsonlFormat().load(kva.logged_data.data_path)[0]) == 8
+
+
+def test_file_hash_streaming_and_cache(setup_env, monkeypatch):
+    path = "/tmp/kva_test_encoder/hashed.bin"
+    content = os.urandom(3 << 20)
+    with open(path, "wb") as f:
+        f.write(content)
+    assert File(path).hash == hashlib.sha256(content).hexdigest()
+    hits = kva_module.utils._hash_file.cache_info().hits
+    assert File(path).hash == hashlib.sha256(content).hexdigest()
+    assert kva_module.utils._hash_file.cache_info().hits == hits + 1
+    with open(path, "ab") as f:
+        f.write(b"more")
+    assert File(path).hash == hashlib.sha256(content + b"more").hexdigest()
+    monkeypatch.setattr(File, "hash_algorithm", "blake2b")
+    kva.init(run_id="hash-run")
+    kva.log(artifact=File(path))
+    logged = kva.get(run_id="hash-run").latest("artifact")
+    assert logged["hash_algorithm"] == "blake2b"
+    assert logged.hash == hashlib.blake2b(content + b"more").hexdigest()
+
+
+def test_artifact_link_and_background_store(setup_env, monkeypatch):
+    src = "/tmp/kva_test_encoder/checkpoint.bin"
+    with open(src, "wb") as f:
+        f.write(os.urandom(1 << 20))
+    dest = "/tmp/kva_test_encoder/linked.bin"
+    assert store_file(src, dest, mode="link") in ("reflink", "hardlink")
+    assert open(dest, "rb").read() == open(src, "rb").read()
+    assert store_file(src, dest, mode="link") == "exists"
+
+    monkeypatch.setattr(DB, "artifact_workers", 2)
+    kva.init(run_id="artifact-run")
+    kva.log(checkpoint=File(src))
+    kva.flush()
+    assert not artifact_store.pending
+    logged = kva.get(run_id="artifact-run").latest("checkpoint")
+    assert open(os.path.join(storage_path(), logged["path"]), "rb").read() == open(src, "rb").read()
+    # Changing the number of workers shuts down the previous pool after its files are stored
+    pool = artifact_store._pool
+    artifact_store.store(src, "/tmp/kva_test_encoder/resized.bin", workers=3)
+    artifact_store.wait()
+    assert pool._shutdown and os.path.exists("/tmp/kva_test_encoder/resized.bin")
+
+
+def test_folder_parallel(setup_env):
+    root = "/tmp/kva_test_encoder/tree"
+    for d in range(3):
+        os.makedirs(f"{root}/d{d}/sub", exist_ok=True)
+        for i in range(20):
+            with open(f"{root}/d{d}/sub/f{i}.txt", "w") as f:
+                f.write(f"{d}-{i}")
+    folder = Folder(root, workers=4)
+    assert list(folder) == os.listdir(root)
+    assert isinstance(folder["d1"]["sub"], Folder) and folder["d1"]["sub"].path == f"{root}/d1/sub"
+    assert folder["d1"]["sub"]["f3.txt"].hash == hashlib.sha256(b"1-3").hexdigest()
+    kva.init(run_id="folder-parallel-run")
+    kva.log(tree=folder)
+    logged = kva.get(run_id="folder-parallel-run").latest("tree")
+    assert set(logged["d2"]["sub"]) == {f"f{i}.txt" for i in range(20)}
+    file = logged["d2"]["sub"]["f7.txt"]
+    assert open(os.path.join(storage_path(), file["path"])).read() == "2-7"
+
+
+def test_appended_table_segments(setup_env):
+    kva.init(run_id="segment-run")
+    table = Table(columns=["step", "sample"])
+    table.add_row(0, "a")
+    kva.log(samples=table)
+    first = kva.get(run_id="segment-run").latest("samples")
+    assert first["filename"] == "table.csv"
+    for step in range(1, 4):
+        table.add_row(step, "b" * step)
+        kva.log(samples=table)
+    latest = kva.get(run_id="segment-run").latest("samples")
+    assert latest["filename"] == "table.segment.csv" and latest["rows"] == 4
+    assert len(pd.read_csv(os.path.join(storage_path(), latest["path"]))) == 1
+    pd.testing.assert_frame_equal(latest.as_df(), pd.DataFrame({"step": [0, 1, 2, 3], "sample": ["a", "b", "bb", "bbb"]}))
+    assert latest.as_df(columns=["sample"])["sample"].tolist() == ["a", "b", "bb", "bbb"]
+    # Changing a logged row stores the whole table again
+    table.loc[0, "sample"] = "z"
+    kva.log(samples=table)
+    changed = kva.get(run_id="segment-run").latest("samples")
+    assert changed["filename"] == "table.csv"
+    assert changed.as_df()["sample"].tolist() == ["z", "b", "bb", "bbb"]
+
+
+def test_concurrent_writers(setup_env):
+    script = (
+        "import sys\n"
+        "from kva import Source, set_storage\n"
+        "set_storage(sys.argv[1])\n"
+        "source = Source.from_context({'test': 'concurrent-writers'})\n"
+        "for i in range(300):\n"
+        "    source.append({'writer': int(sys.argv[2]), 'i': i, 'padding': 'x' * 1000})\n"
+        "    if i % 7 == 0:\n"
+        "        source.write()\n"
+        "source.write()\n"
+    )
+    writers = [subprocess.Popen([sys.executable, '-c', script, storage_path(), str(writer)]) for writer in range(4)]
+    assert all(writer.wait() == 0 for writer in writers)
+    source = Source.from_context({'test': 'concurrent-writers'})
+    # A crashed writer leaves an unfinished line, which the next writer removes
+    with open(source.data_path, 'a') as f:
+        f.write('{"writer": 5, "i"')
+    source.append({'writer': 4, 'i': 0})
+    source.write()
+    source.rows, source._files = [], {}
+    source.refresh()
+    assert len(source.rows) == 1201
+    for writer in range(4):
+        assert [row['i'] for row in source.rows if row['writer'] == writer] == list(range(300))
+    assert source.rows[-1] == {'writer': 4, 'i': 0}
+
+
+def test_writer_segments_and_compact(setup_env):
+    script = (
+        "import sys\n"
+        "from datetime import datetime\n"
+        "from kva import Source, set_storage\n"
+        "set_storage(sys.argv[1])\n"
+        "source = Source.from_context({'test': 'segments'})\n"
+        "for i in range(200):\n"
+        "    source.append({'writer': int(sys.argv[2]), 'i': i, 'timestamp': datetime.now().isoformat()})\n"
+        "    if i % 7 == 0:\n"
+        "        source.write()\n"
+        "source.write()\n"
+    )
+    env = dict(os.environ, KVA_WRITER='auto')
+    writers = [subprocess.Popen([sys.executable, '-c', script, storage_path(), str(writer)], env=env)
+               for writer in range(3)]
+    assert all(writer.wait() == 0 for writer in writers)
+    source = Source.from_context({'test': 'segments'})
+    assert not os.path.exists(source.data_path)
+    assert len(segment_paths(source.data_path)) == 3
+    rows = source.data
+    assert len(rows) == 600
+    assert [row['timestamp'] for row in rows] == sorted(row['timestamp'] for row in rows)
+    for writer in range(3):
+        assert [row['i'] for row in rows if row['writer'] == writer] == list(range(200))
+    assert source.data_path in compact()
+    assert segment_paths(source.data_path) == []
+    assert JsonlFormat().load(source.data_path)[0] == rows
+    assert source.data == rows
+
+
+def test_server_panels_cached_until_data_changes(setup_env, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from kva import server
+
+    config = tmp_path / "view.yaml"
+    config.write_text("index: [run_id]\npanels:\n"
+                      "- {name: Loss, columns: [loss], type: lineplot, index: step}\n"
+                      "- {name: Missing, columns: [nothing], type: data}\n")
+    monkeypatch.setattr(server, "config_path", str(config))
+    client = TestClient(server.app)
+    kva.init(run_id="server-run")
+    kva.log(step=1, loss=0.5)
+    response = client.get("/data/server-run")
+    assert response.json() == {"Loss": {"data": [{"step": 1, "loss": 0.5}], "type": "lineplot", "index": "step", "slider": None, "rows": 1}}
+    calls = []
+    monkeypatch.setattr(DB, "latest", lambda self, *args, **kwargs: calls.append(args))
+    assert client.get("/data/server-run").content == response.content
+    assert calls == []
+    monkeypatch.undo()
+    monkeypatch.setattr(server, "config_path", str(config))
+    kva.log(step=2, loss=0.25)
+    assert [row["loss"] for row in client.get("/data/server-run").json()["Loss"]["data"]] == [0.5, 0.25]
+    # The config is reloaded when it changes
+    config.write_text("index: [run_id]\npanels: []\n")
+    os.utime(config, ns=(0, 0))
+    assert client.get("/data/server-run").json() == {}
+
+
+def test_downsample():
+    x = np.arange(100000, dtype=float)
+    y = np.sin(x / 1000)
+    y[54321] = 10
+    for method in (minmax, lttb):
+        selected = method(x, y, 500)
+        assert len(selected) <= 500 and selected[0] == 0 and selected[-1] == len(x) - 1
+        assert np.all(np.diff(selected) > 0)
+        assert 54321 in selected
+    df = pd.DataFrame({"loss": y, "eval": np.where(x % 1000 == 0, 1.0, np.nan)}, index=pd.Index(x, name="step"))
+    sampled = downsample(df, 100)
+    assert len(sampled) < 300
+    # Sparse columns keep all their values if there are less than `points` of them
+    assert sampled["eval"].notna().sum() == 100
+
+
+def test_server_downsamples_lineplots(setup_env, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from kva import server
+
+    config = tmp_path / "view.yaml"
+    config.write_text("index: [run_id]\npanels:\n"
+                      "- {name: Loss, columns: [loss], type: lineplot, index: step}\n"
+                      "- {name: Summary, columns: '*', type: data}\n")
+    monkeypatch.setattr(server, "config_path", str(config))
+    client = TestClient(server.app)
+    kva.init(run_id="downsample-run")
+    kva.log_arrays(step=np.arange(5000), loss=np.linspace(1, 0, 5000))
+    panel = client.get("/data/downsample-run", params={"points": 100}).json()["Loss"]
+    assert panel["rows"] == 5000 and len(panel["data"]) <= 100
+    # Zooming in returns all points of the range
+    zoomed = client.get("/data/downsample-run", params={"panel": "Loss", "x_min": 100, "x_max": 149}).json()
+    assert list(zoomed) == ["Loss"]
+    assert [row["step"] for row in zoomed["Loss"]["data"]] == list(range(100, 150))
+    assert len(client.get("/data/downsample-run", params={"points": 0}).json()["Loss"]["data"]) == 5000
+    # Errors are returned with their status instead of a truncated response
+    assert client.get("/data/downsample-run", params={"x_min": "abc"}).status_code == 400
+    monkeypatch.setattr(server, "render_panel", lambda *args: 1 / 0)
+    assert TestClient(server.app, raise_server_exceptions=False).get("/data/downsample-run").status_code == 500
+
+
+def test_stream_pushes_changed_panels(setup_env, tmp_path, monkeypatch):
+    import httpx
+    import uvicorn
+    from kva import server
+
+    config = tmp_path / "view.yaml"
+    config.write_text("index: [run_id]\npanels:\n"
+                      "- {name: Loss, columns: [loss], type: lineplot, index: step}\n"
+                      "- {name: Config, columns: [config], type: data}\n")
+    monkeypatch.setattr(server, "config_path", str(config))
+    kva.init(run_id="stream-run")
+    kva.log(config={"lr": 0.1})
+    kva.log(step=1, loss=0.5)
+    kva.flush()
+    # The test client waits for the end of a response, so the stream is read from a server
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, port=0, log_level="error"))
+    thread = threading.Thread(target=uvicorn_server.run, daemon=True)
+    thread.start()
+    while not uvicorn_server.started:
+        time.sleep(0.01)
+    port = uvicorn_server.servers[0].sockets[0].getsockname()[1]
+    try:
+        with httpx.stream("GET", f"http://127.0.0.1:{port}/stream/stream-run", timeout=10) as response:
+            events = (json.loads(line[len("data: "):]) for line in response.iter_lines() if line.startswith("data: "))
+            assert set(next(events)) == {"Loss", "Config"}
+            kva.log(step=2, loss=0.25)
+            kva.flush()
+            update = next(events)
+            assert list(update) == ["Loss"]
+            assert [row["loss"] for row in update["Loss"]["data"]] == [0.5, 0.25]
+            # Contexts that are created after connecting are part of the run
+            with kva.context(epoch=1):
+                kva.log(step=3, loss=0.125)
+            kva.flush()
+            assert [row["loss"] for row in next(events)["Loss"]["data"]] == [0.5, 0.25, 0.125]
+    finally:
+        uvicorn_server.should_exit = True
+        thread.join()
+
+
+def test_runs_listed_from_summaries(setup_env, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from kva import server
+
+    config = tmp_path / "view.yaml"
+    config.write_text("index: [run_id]\npanels: []\n")
+    monkeypatch.setattr(server, "config_path", str(config))
+    for run_id in ["runs-a", "runs-b"]:
+        kva.init(run_id=run_id)
+        kva.log(step=1, loss=0.5, split="train")
+    kva.flush()
+    # Neither listing runs nor inferring the default config reads rows
+    monkeypatch.setattr(Source, "data", property(lambda self: pytest.fail("rows were read")))
+    client = TestClient(server.app)
+    response = client.get("/runs", params={"order": "desc"}).json()
+    assert response["total"] == len(response["runs"])
+    assert response["runs"].index("runs-b") < response["runs"].index("runs-a")
+    assert client.get("/runs", params={"order": "desc", "offset": 1, "limit": 2}).json()["runs"] == response["runs"][1:3]
+    with open(server.make_config()) as f:
+        panels = {panel["name"]: panel for panel in yaml.safe_load(f)["panels"]}
+    assert panels["loss"] == {"name": "loss", "columns": ["loss"], "type": "lineplot", "index": "step"}
+    assert "split" not in panels
+
+
+def test_summary_of_context_written_without_summary(setup_env, monkeypatch):
+    from kva.index import ContextSummary, read_summary
+
+    context = {"test": "written-without-summary"}
+    source = Source.from_context(context)
+    source.append({"acc": 0.5})
+    source.write()
+    # A context that was written before summaries existed, continued by a new process
+    os.remove(ContextSummary.path(source.context_hash))
+    del kva_module.data_sources[source.context_hash]
+    source = Source.from_context(context)
+    source.append({"loss": 0.25})
+    # Rows that are appended while the first summary is written are summarized when they are written
+    pack = source.format.pack
+    monkeypatch.setattr(source.format, "pack", lambda lines: (source.append({"late": 1}), pack(lines))[1])
+    source.write()
+    monkeypatch.undo()
+    assert set(read_summary(source.context_hash).types) == {"acc", "loss"}
+    source.write()
+    assert set(read_summary(source.context_hash).types) == {"acc", "loss", "late"}
+
+
+def test_artifact_caching_and_ranges(setup_env, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from kva import server
+
+    log_src = tmp_path / "train.log"
+    log_src.write_text("line\n" * 1000)
+    kva.init(run_id="artifact-serving-run")
+    kva.log(log=LogFile(str(log_src)), file=File(str(log_src)))
+    kva.flush()
+    client = TestClient(server.app)
+
+    # Log files are found without linking them into the artifacts, revalidated and served in ranges
+    assert not os.path.exists(os.path.join(storage_path(), "artifacts", "logfiles", "artifact-serving-run"))
+    response = client.get("/artifacts/logfiles/artifact-serving-run/train.log")
+    assert response.text == log_src.read_text()
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["cache-control"] == "no-cache"
+    assert client.get("/artifacts/logfiles/artifact-serving-run/train.log",
+                      headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+    partial = client.get("/artifacts/logfiles/artifact-serving-run/train.log", headers={"Range": "bytes=5-9"})
+    assert partial.status_code == 206 and partial.content == b"line\n"
+    with open(log_src, "a") as f:
+        f.write("more\n")
+    assert client.get("/artifacts/logfiles/artifact-serving-run/train.log",
+                      headers={"If-None-Match": response.headers["etag"]}).text.endswith("more\n")
+
+    # Stored files are immutable and identified by their hash
+    path = kva.get(run_id="artifact-serving-run").latest("file")["path"]
+    response = client.get(f"/{path}", headers={"Accept-Encoding": "identity"})
+    assert response.content == b"line\n" * 1000
+    assert response.headers["cache-control"] == server.immutable
+    assert response.headers["etag"] == f'"{path.split("/")[1]}"'
+    assert client.get(f"/{path}", headers={"If-None-Match": response.headers["etag"],
+                                           "Accept-Encoding": "identity"}).status_code == 304
+
+    # The log files of a run are looked up again when rows are added, and missing files are cached too
+    other_src = tmp_path / "other" / "train.log"
+    other_src.parent.mkdir()
+    other_src.write_text("other\n")
+    kva.log(log=LogFile(str(other_src)))
+    kva.flush()
+    assert client.get("/artifacts/logfiles/artifact-serving-run/train.log").text == "other\n"
+    lookups = []
+    latest = DB.latest
+    monkeypatch.setattr(DB, "latest", lambda self, *args, **kwargs: lookups.append(args) or latest(self, *args, **kwargs))
+    assert client.get("/artifacts/logfiles/artifact-serving-run/missing.log").status_code == 404
+    assert client.get("/artifacts/logfiles/artifact-serving-run/missing.log").status_code == 404
+    assert lookups == []
+
+
+def test_logfile_tail(setup_env, tmp_path, monkeypatch):
+    from fastapi.testclient import TestClient
+    from kva import server, tail
+
+    monkeypatch.setattr(tail, "block_size", 16)
+    log_src = tmp_path / "tail.log"
+    log_src.write_text("".join(f"line {i}\n" for i in range(100)))
+    kva.init(run_id="logfile-tail-run")
+    logfile = LogFile(str(log_src))
+    kva.log(log=logfile)
+    client = TestClient(server.app)
+    url = "/artifacts/logfiles/logfile-tail-run/tail.log/tail"
+
+    response = client.get(url, params={"lines": 3}).json()
+    assert response["text"] == "line 97\nline 98\nline 99\n"
+    assert response["next"] == response["size"] == log_src.stat().st_size
+    with open(log_src, "a") as f:
+        f.write("line 100\nline 1")
+    # Only complete lines are returned while more follows
+    response = client.get(url, params={"offset": response["next"], "limit": 12}).json()
+    assert response["text"] == "line 100\n"
+    response = client.get(url, params={"offset": response["next"]}).json()
+    assert response["text"] == "line 1" and response["next"] == log_src.stat().st_size
+
+    # The final log adds what was appended to the hash, and is skipped while the log is unchanged
+    logfile.log_final()
+    assert kva.get(run_id="logfile-tail-run").latest("log")["hash"] == File._calculate_hash(str(log_src))
+    with open(log_src, "a") as f:
+        f.write("01\n")
+    logfile.log_final()
+    assert kva.get(run_id="logfile-tail-run").latest("log")["hash"] == hashlib.sha256(log_src.read_bytes()).hexdigest()
+    monkeypatch.setattr(kva, "log", lambda *args: pytest.fail("an unchanged log was logged"))
+    logfile.log_final()
+
+
 if __name__ == "__main__":
     pytest.main()
@@ -1,15 +1,27 @@
 import atexit
+import copy
 import hashlib
+import importlib.util
 import json
 import os
 import pickle
 import shutil
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 from logging import getLogger
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 
+import numpy as np
 import pandas as pd
+from tqdm import tqdm
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
 
 _STORAGE = "/workspace/kva_store" if os.path.exists("/workspace") else "~/.kva"
 if os.environ.get("KVA_STORAGE"):
@@ -30,16 +42,130 @@ def set_storage(path: str):
 
 def storage_path():
     return _STORAGE
+
+
+def load_jsonl(path, offset=0):
+    """Parses the complete lines of a jsonl file starting at a byte offset. Lines that can't be parsed, e.g. the
+    beginning of a line that a crashed process didn't finish, are skipped.
+    Returns (rows, offset after the last complete line)."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b'\n') + 1
+    rows = []
+    for line in chunk[:end].splitlines():
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            logger.warning(f"Skipping a line of {path} that is not valid json: {line[:100]!r}")
+    return rows, offset + end
+
+
+@contextmanager
+def locked_append(path: str):
+    """Opens a file for appending and holds an exclusive advisory lock on it, so that processes that append to the
+    same file don't interleave their writes. Yields the file descriptor."""
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if fcntl is None:
+            break
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        # The file has been replaced or removed while we waited for the lock, e.g. by kva compact
+        os.close(fd)
+    try:
+        yield fd
+    finally:
+        os.close(fd) # Releases the lock
+
+
+def write_all(fd: int, data: bytes):
+    """Writes data with as few write calls as possible, retrying if only a part of it was written."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
     
 
 class Table(pd.DataFrame):
+    """A DataFrame that can be logged repeatedly while rows are added: when a table is logged again, only the rows
+    that have been added since it was logged last are stored, as a segment that references the previous version."""
+    _metadata = ['_segment']
+    _segment = None # The logged version: {'data': logged dict, 'rows': number of rows, 'prefix': hash of the rows, 'columns': [...]}
+
     def add_row(self, *values, **data):
         data = dict(zip(self.columns, values), **data)
         new_row = pd.DataFrame([data], columns=self.columns)
         self._update_inplace(pd.concat([self, new_row], ignore_index=True))
 
 
+@lru_cache(maxsize=65536)
+def _hash_file(path: str, size: int, mtime_ns: int, inode: int, algorithm: str) -> str:
+    """Hashes a file in chunks. The size, mtime and inode are part of the cache key, so that changed files are hashed again."""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def map_batched(func: Callable[[Any], Any], items: List[Any], workers: int, desc: str = None, progress: bool = False) -> List[Any]:
+    """Returns [func(item) for item in items], computed on `workers` threads. Items are processed in batches,
+    as most items (e.g. small files) take less time than scheduling them on a thread."""
+    batch_size = max(1, min(64, len(items) // (4 * workers)))
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool, tqdm(total=len(items), desc=desc, disable=not progress) as bar:
+        for batch in pool.map(lambda batch: [func(item) for item in batch], batches):
+            results += batch
+            bar.update(len(batch))
+    return results
+
+
+def parquet_available() -> bool:
+    return any(importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet'))
+
+
+@lru_cache(maxsize=32)
+def read_table(path: str, columns: Optional[tuple] = None) -> pd.DataFrame:
+    """Reads a table artifact (parquet or csv). Artifacts are stored by their hash and never change, so the
+    tables are cached by path. The cached dataframe should not be modified."""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=list(columns) if columns else None)
+    df = pd.read_csv(path, usecols=list(columns) if columns else None)
+    return df[list(columns)] if columns else df
+
+
+@lru_cache(maxsize=65536)
+def _previous_segment(path: str) -> Optional[str]:
+    segment_file = os.path.join(os.path.dirname(path), 'segment.json')
+    if not os.path.basename(path).startswith('table.segment.') or not os.path.exists(segment_file):
+        return None
+    with open(segment_file, 'r') as f:
+        return os.path.normpath(os.path.join(os.path.dirname(path), json.load(f)['previous']))
+
+
+def read_table_segments(path: str, columns: Optional[tuple] = None) -> pd.DataFrame:
+    """Reads a table artifact together with the previous segments of an appended table. Segments are cached by
+    `read_table`, so reading a new version of a table only parses its new rows. The dataframe should not be modified."""
+    paths = [path]
+    while _previous_segment(paths[-1]) is not None:
+        paths.append(_previous_segment(paths[-1]))
+    if len(paths) == 1:
+        return read_table(path, columns)
+    return pd.concat([read_table(path, columns) for path in reversed(paths)], ignore_index=True)
+
+
 class File(dict):
+    # Any algorithm of hashlib, e.g. blake2b which is faster than sha256 on 64 bit machines.
+    # Files that are not hashed with sha256 record the algorithm as `hash_algorithm`.
+    hash_algorithm = os.environ.get('KVA_HASH_ALGORITHM', 'sha256')
+
     def __init__(
         self,
         src: Optional[str] = None,
@@ -52,7 +178,9 @@ class File(dict):
         self.src = src # User provided path
         # Remaining info is set by the DB instance via which the file is logged
         self.path = path # Path relative to the storage
-        self.hash = hash or self._calculate_hash(src) # Hash of the file
+        if hash is None and self.hash_algorithm != 'sha256':
+            kwargs['hash_algorithm'] = self.hash_algorithm
+        self.hash = hash or self._calculate_hash(src, kwargs.get('hash_algorithm', 'sha256')) # Hash of the file
         self.filename = filename or os.path.basename(src) # Filename
         self.base_path = base_path # Base path of the storage
 
@@ -64,19 +192,17 @@ class File(dict):
         return f"File(src={self.src!r}, path={self.path!r}, hash={self.hash!r}, filename={self.filename!r})"
 
     @staticmethod
-    def _calculate_hash(path: str) -> str:
-        hasher = hashlib.sha256()
-        with open(path, "rb") as f:
-            buf = f.read()
-            hasher.update(buf)
-        return hasher.hexdigest()
+    def _calculate_hash(path: str, algorithm: str = 'sha256') -> str:
+        stat = os.stat(path)
+        return _hash_file(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm)
 
-    def as_df(self):
+    def as_df(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads a logged table, optionally only the given columns."""
         if self.base_path is None or self.path is None:
             raise ValueError(
                 "Can only get the dataframe after a table has been logged."
             )
-        return pd.read_csv(os.path.join(self.base_path, self.path))
+        return read_table_segments(os.path.join(self.base_path, self.path), tuple(columns) if columns else None).copy()
 
 
 class LogFile(dict):
@@ -87,14 +213,39 @@ class LogFile(dict):
         self.hash = None
         self.report_to = None
         self.report_context = None
+        self._logged = None # (inode, size, mtime) of the file when it was last logged by log_final
+        self._hashed = None # (inode, offset, hasher, last bytes) of the part of the file that has been hashed
         atexit.register(self.log_final)
         super().__init__(src=self.src, path='?', run_id=self.path, filename=self.filename)
     
     def log_final(self):
         if self.report_to:
-            data = {k: v if v != self else File(self.src) for k, v in self.report_context.items()}
+            stat = os.stat(self.src)
+            if self._logged == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                return
+            kwargs = {} if File.hash_algorithm == 'sha256' else {'hash_algorithm': File.hash_algorithm}
+            file = File(self.src, hash=self._hash(stat), **kwargs)
+            data = {k: v if v != self else file for k, v in self.report_context.items()}
             self.report_to.log(data)
             self.report_to.logged_data.write()
+            self._logged = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _hash(self, stat: os.stat_result) -> str:
+        """Hashes the log incrementally: only lines that have been appended since the last call are read, unless
+        the file has been replaced or rewritten, which is detected by its inode, size and last hashed bytes."""
+        inode, offset, hasher, last = self._hashed or (None, 0, None, b'')
+        with open(self.src, 'rb') as f:
+            f.seek(offset - len(last))
+            if inode != stat.st_ino or offset > stat.st_size or f.read(len(last)) != last:
+                offset, hasher = 0, hashlib.new(File.hash_algorithm)
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+            offset = f.tell()
+            f.seek(max(0, offset - 4096))
+            last = f.read(offset - f.tell())
+        self._hashed = (stat.st_ino, offset, hasher, last)
+        return hasher.hexdigest()
     
     @property
     def path(self):
@@ -105,18 +256,36 @@ class LogFile(dict):
 
 
 class Folder(dict):
-    def __init__(self, path: str):
+    # Number of threads that hash the files of a folder, and store them when the folder is logged
+    workers = max(1, int(os.environ.get('KVA_FOLDER_WORKERS', 8)))
+
+    def __init__(self, path: str, workers: Optional[int] = None, progress: bool = False):
         super().__init__()
         self.path = path
+        self.workers = workers or self.workers
+        self.progress = progress # Show progress bars while hashing and storing the files
         self._populate()
 
     def _populate(self):
-        for item in os.listdir(self.path):
-            item_path = os.path.join(self.path, item)
-            if os.path.isdir(item_path):
-                self[item] = Folder(item_path)
-            else:
-                self[item] = File(item_path)
+        files = []
+        self._scan(files)
+        paths = [os.path.join(folder.path, name) for folder, name in files]
+        hashes = map_batched(File._calculate_hash, paths, self.workers, f"Hashing {self.path}", self.progress)
+        for (folder, name), path, hash in zip(files, paths, hashes):
+            folder[name] = File(path, hash=hash)
+
+    def _scan(self, files: List[tuple]):
+        """Adds subfolders and placeholders for the files of this folder, and appends (folder, name) of each file to `files`."""
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folder = self[entry.name] = Folder.__new__(Folder)
+                    dict.__init__(folder)
+                    folder.path, folder.workers, folder.progress = entry.path, self.workers, self.progress
+                    folder._scan(files)
+                else:
+                    self[entry.name] = None
+                    files.append((self, entry.name))
 
     def __repr__(self):
         return f"Folder(path={self.path!r}, contents={list(self.keys())!r})"
@@ -130,57 +299,74 @@ def _deep_merge(a: Any, b: Any) -> Any:
     return b
 
 
-class Container:
-    def __init__(self, val):
-        self.val = val
+def _deep_merge_tracked(a: Any, b: Any, resets: set, path: tuple = ()) -> Any:
+    """Like _deep_merge, but copies the dicts of b instead of reusing them, and adds the paths at which
+    a non-dict value of b replaced the previous value to `resets`."""
+    if not isinstance(b, dict):
+        resets.add(path)
+        return b
+    if not isinstance(a, dict):
+        a = {}
+    for key in b:
+        a[key] = _deep_merge_tracked(a.get(key), b[key], resets, path + (key,))
+    return a
+
+
+def _deep_merge_replayed(a: Any, b: Any, resets: set, path: tuple = ()) -> Any:
+    """Merges b, the result of _deep_merge_tracked, into a as if the values that produced b had been merged
+    into a one by one. Values of b are copied."""
+    if path in resets or not isinstance(a, dict) or not isinstance(b, dict):
+        return copy.deepcopy(b)
+    for key in b:
+        a[key] = _deep_merge_replayed(a.get(key), b[key], resets, path + (key,))
+    return a
 
 
 def get_latest_nonnull(df, index: Union[List[str], str], columns: List[str], deep_merge: bool = False):
     """Gets a dataframe and returns a new dataframe where:
     - the df is grouped by the index columns
     - for each of the columns, the last non-null value of the group is taken
-    The result is a dataframe with the specified index and columns, where the values are the last non-null values of the group.
+    The result is a dataframe with the specified index and columns, where the values are the last non-null values of the group,
+    or NaN for groups without values. With deep_merge, dict values of a group are deep merged in order (without modifying the values of df).
     """
     if isinstance(index, str):
         index = [index]
     # Set None and NaN values in index column to `None` to avoid grouping issues
     for col in index:
-        df[col] = df[col].apply(lambda x: 'None' if pd.isnull(x) else x)
+        null = df[col].isna()
+        if null.any():
+            df[col] = df[col].astype(object).where(~null, 'None')
     columns = [col for col in columns if col in df.columns]
     index = [col for col in index if col in df.columns]
     if not index or not columns:
         return pd.DataFrame()
 
-
-    def last_non_null(series):
-        if not deep_merge:
-            val = series.dropna().iloc[-1] if not series.dropna().empty else None
-            if isinstance(val, dict):
-                return Container(val)
-            else:
-                return val
-        else:
-            vals = series.dropna().tolist()
-            if not vals:
-                return None
-            current = vals[0]
-            for val in vals[1:]:
-                current = _deep_merge(current, val)
-            if isinstance(current, dict):
-                return Container(current)
-            return current
-        
     grouped = df.groupby(index)
-    result = grouped[columns].apply(lambda x: x.apply(last_non_null))
-
-    # Unpack Container objects
-    def unpack(val):
-        if isinstance(val, Container):
-            return val.val
-        return val
-
-    result = result.map(unpack)
-    return result
+    codes = grouped.ngroup().to_numpy()
+    result = {}
+    for col in columns:
+        series = df[col]
+        present = np.flatnonzero(series.notna().to_numpy())
+        values = series.to_numpy(dtype=object)
+        # Position of the last non-null value of each group
+        reversed_codes = codes[present][::-1]
+        groups, first = np.unique(reversed_codes, return_index=True)
+        last = present[::-1][first]
+        column = np.full(grouped.ngroups, np.nan, dtype=object)
+        column[groups] = values[last]
+        if deep_merge and series.dtype == object:
+            # Only groups whose last value is a dict differ from the last value when merged
+            dict_groups = {g for g, v in zip(groups, values[last]) if isinstance(v, dict)}
+            merged = {}
+            for i in present:
+                g = codes[i]
+                if g in dict_groups:
+                    merged[g] = _deep_merge_tracked(merged.get(g), values[i], set())
+            for g, value in merged.items():
+                column[g] = value
+        result[col] = column
+    # Infer the dtypes of the columns like pandas does for a list of python values
+    return pd.DataFrame(result, index=grouped.size().index).map(lambda x: x)
 
 
 class CustomJSONEncoder(json.JSONEncoder):
@@ -232,6 +418,43 @@ class CustomJSONEncoder(json.JSONEncoder):
         return file_path
 
 
+_JSON_SCALARS = {str, int, float, bool, type(None)}
+
+
+def _json_key(key: Any) -> str:
+    """Returns the string that json uses for a dict key."""
+    if isinstance(key, str):
+        return str.__str__(key)
+    if key is None or isinstance(key, (int, float)):
+        return json.dumps(key)
+    raise TypeError(f"keys must be str, int, float, bool or None, not {type(key).__name__}")
+
+
+def to_json_native(value: Any, process: Optional[Callable[[Any], Any]] = None, encoder: Optional[json.JSONEncoder] = None) -> Any:
+    """Returns a copy of value that consists of json types only, like json.loads(json.dumps(value, cls=CustomJSONEncoder))
+    but in a single pass. If given, `process` is applied to every value that is not a json scalar before it is converted."""
+    if type(value) in _JSON_SCALARS:
+        return value
+    if process is not None:
+        value = process(value)
+    if isinstance(value, dict):
+        return {
+            k if type(k) is str else _json_key(k): v if type(v) in _JSON_SCALARS else to_json_native(v, process, encoder)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [v if type(v) in _JSON_SCALARS else to_json_native(v, process, encoder) for v in value]
+    if isinstance(value, str):
+        # Like json, which stores the string and not str(value), e.g. of a (str, Enum) member
+        return str.__str__(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    encoder = encoder or CustomJSONEncoder()
+    # Like json.dumps, which doesn't process the result of the encoder, e.g. the File of a pickled object
+    return to_json_native(encoder.default(value), None, encoder)
+
 
 def return_false_on_exception(func):
     def wrapper(*args, **kwargs):
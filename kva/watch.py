@@ -0,0 +1,124 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, Optional, Set
+
+from kva.utils import logger
+
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, length of the name
+
+
+def _inotify(path: str) -> int:
+    """Returns an inotify file descriptor that watches the files in a directory, raises OSError where inotify is not available."""
+    name = ctypes.util.find_library('c')
+    libc = ctypes.CDLL(name, use_errno=True) if name else None
+    if libc is None or not hasattr(libc, 'inotify_init1'):
+        raise OSError("inotify is not available")
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), f"Watching {path} failed")
+    return fd
+
+
+def _context_hash(name: str) -> Optional[str]:
+    return name.split('.')[0] if '.data.' in name and not name.endswith('.tmp') else None
+
+
+class StorageWatcher:
+    """Watches the data files of a storage directory on a background thread, with inotify where it is available and
+    by checking the files every `poll_interval` seconds otherwise. Subscribers are called on that thread with the
+    hashes of the contexts whose data changed, or None if that is not known."""
+    poll_interval = float(os.environ.get('KVA_WATCH_INTERVAL', 1))
+
+    def __init__(self, path: str):
+        self.path = path
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, callback: Callable[[Optional[Set[str]]], None]) -> Callable[[], None]:
+        """Calls `callback` on changes until the returned function is called."""
+        with self._lock:
+            self._subscribers.add(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='kva-watcher')
+                self._thread.start()
+        return lambda: self._unsubscribe(callback)
+
+    def _unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.discard(callback)
+
+    def _notify(self, hashes: Optional[Set[str]]):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(hashes)
+            except Exception as e:
+                logger.error(f"Notifying a subscriber about changes in {self.path} failed: {e}")
+
+    def _run(self):
+        try:
+            fd = _inotify(self.path)
+        except OSError as e:
+            logger.info(f"Checking {self.path} for changes every {self.poll_interval}s: {e}")
+            self._poll()
+            return
+        while True:
+            data = os.read(fd, 1 << 16)
+            hashes = set()
+            pos = 0
+            while pos < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, pos)
+                name = data[pos + _EVENT.size:pos + _EVENT.size + length].rstrip(b'\0').decode(errors='replace')
+                pos += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    hashes = None
+                    break
+                context_hash = _context_hash(name)
+                if context_hash is not None:
+                    hashes.add(context_hash)
+            if hashes is None or hashes:
+                self._notify(hashes)
+
+    def _poll(self):
+        stats = self._stats()
+        while True:
+            time.sleep(self.poll_interval)
+            new_stats = self._stats()
+            hashes = {_context_hash(name) for name in new_stats.keys() | stats.keys() if new_stats.get(name) != stats.get(name)}
+            stats = new_stats
+            if hashes:
+                self._notify(hashes)
+
+    def _stats(self) -> Dict[str, tuple]:
+        stats = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if _context_hash(entry.name) is not None:
+                    stat = entry.stat()
+                    stats[entry.name] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return stats
+
+
+_watchers: Dict[str, StorageWatcher] = {}
+_watchers_lock = threading.Lock()
+
+
+def watcher(path: str) -> StorageWatcher:
+    """The watcher of a storage directory, which is shared by all subscribers."""
+    with _watchers_lock:
+        if path not in _watchers:
+            _watchers[path] = StorageWatcher(path)
+        return _watchers[path]
@@ -16,6 +16,7 @@ setup(
     entry_points={
         'console_scripts': [
             'kva-ui = kva.server:main',  # This assumes server.py has a main() function
+            'kva = kva.cli:main',
         ],
     },
     classifiers=[